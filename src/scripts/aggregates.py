@@ -0,0 +1,151 @@
+import pandas as pd
+import numpy as np
+
+# Измерения, по которым задания plots.py группируют данные
+DIMENSIONS = ['district', 'street', 'floor', 'multi_floor', 'type_property', 'rooms_cat']
+ROOM_ORDER = ['0', '1', '2', '3', '4+']
+# С этого числа строк квантили для отсечения выбросов берутся из скетчей (sketches.py, ошибка до 1%):
+# группы не сортируются целиком, вместо значений - счетчики корзин
+EXACT_QUANTILE_ROWS = 1_000_000
+
+
+def add_rooms_cat(df):
+    # 0 комнат - студия, 4 и больше - одна категория
+    rooms = pd.to_numeric(df['rooms_count'], errors='coerce').fillna(0).astype(int)
+    df['rooms_count'] = rooms
+    df['rooms_cat'] = pd.Categorical(
+        np.select([rooms == 0, rooms == 1, rooms == 2, rooms == 3], ROOM_ORDER[:4], default='4+'),
+        categories=ROOM_ORDER
+    )
+    return df
+
+
+def _keys(df, by):
+    return [df[k] for k in ([by] if isinstance(by, str) else by)]
+
+
+def _sketch(df, column, by):
+    import sketches
+
+    keys = pd.DataFrame({f"key_{i}": key.to_numpy() for i, key in enumerate(_keys(df, by))}, index=df.index)
+    return sketches.sketch(keys, df[column], column), list(keys.columns)
+
+
+def trim_outliers(df, column, by=None, lower=0.05, upper=0.95, exact=None):
+    # Убирает строки, где column за квантилями lower/upper своей группы by (район, тип, комнаты...).
+    # Границы считаются groupby().transform по всем группам сразу, фрейм фильтруется одной маской;
+    # на больших фреймах (exact=False) - по скетчам групп
+    values = df[column].astype('float64')
+    exact = len(df) <= EXACT_QUANTILE_ROWS if exact is None else exact
+    if not exact:
+        import sketches
+
+        table, names = _sketch(df, column, [] if by is None else by)
+        if by is None:
+            low, high = sketches.quantiles(table, [], lower), sketches.quantiles(table, [], upper)
+        else:
+            keys = _keys(df, by)
+            index = pd.MultiIndex.from_arrays(keys) if len(keys) > 1 else pd.Index(keys[0])
+            low = sketches.quantiles(table, names, lower).reindex(index).to_numpy()
+            high = sketches.quantiles(table, names, upper).reindex(index).to_numpy()
+    elif by is None:
+        low, high = values.quantile(lower), values.quantile(upper)
+    else:
+        grouped = values.groupby(_keys(df, by), observed=True)
+        low = grouped.transform('quantile', lower)
+        high = grouped.transform('quantile', upper)
+    return df[~((values < low) | (values > high))]
+
+
+def trimmed_mean(df, column, by, lower=0.05, upper=0.95, exact=None):
+    # Среднее по группам без выбросов за квантилями lower/upper внутри каждой группы;
+    # на больших фреймах - за один проход по скетчам групп, без отбора строк
+    exact = len(df) <= EXACT_QUANTILE_ROWS if exact is None else exact
+    if not exact:
+        import sketches
+
+        table, names = _sketch(df, column, by)
+        means = sketches.trimmed_means(table, names, lower, upper).rename(column)
+        return means.rename_axis([by] if isinstance(by, str) else list(by))
+    trimmed = trim_outliers(df, column, by, lower, upper, exact=True)
+    return trimmed[column].astype('float64').groupby(_keys(trimmed, by), observed=True).mean()
+
+
+def top_k_distinct(df, by, distinct, value, k=2, groups=None, ascending=False):
+    # Топ-k строк по value в каждой группе by, не больше одной строки на значение distinct.
+    # Одна сортировка и один drop_duplicates вместо цикла по группам и строкам
+    data = df if groups is None else df[df[by].isin(groups)]
+    data = data.sort_values(value, ascending=ascending, kind='stable')
+    data = data.drop_duplicates([by, distinct])
+    result = data.groupby(by, sort=False, observed=True).head(k)
+    if groups is not None:
+        # Группы в порядке переданного списка, внутри группы - по value
+        order = pd.Categorical(result[by], categories=list(groups), ordered=True)
+        result = result.iloc[np.argsort(order.codes, kind='stable')]
+    return result.reset_index(drop=True)
+
+
+class Aggregates:
+    # Предрасчитанная таблица сумм/счетчиков/экстремумов на самой мелкой сетке измерений.
+    # Любая группировка заданий - свертка этой таблицы, без повторного прохода по строкам
+    def __init__(self, grain, trimmed):
+        self.grain = grain
+        self.trimmed = trimmed
+
+    def _rows(self, where):
+        return self.grain if where is None else self.grain[where(self.grain)]
+
+    def by(self, keys, where=None, sort=True):
+        table = self._rows(where)
+        grouped = table.groupby(keys, observed=True, sort=sort).agg(
+            price_sum=('price_sum', 'sum'),
+            price_count=('price_count', 'sum'),
+            price_min=('price_min', 'min'),
+            price_max=('price_max', 'max'),
+            ppm2_sum=('ppm2_sum', 'sum'),
+            ppm2_count=('ppm2_count', 'sum'),
+            ppm2_min=('ppm2_min', 'min'),
+            ppm2_max=('ppm2_max', 'max'),
+        )
+        grouped = grouped[grouped['price_count'] > 0]
+        grouped['price_mean'] = grouped['price_sum'] / grouped['price_count']
+        grouped['ppm2_mean'] = grouped['ppm2_sum'] / grouped['ppm2_count']
+        return grouped
+
+    def mean(self, keys, where=None, sort=True):
+        # Средняя цена по ключам - замена df.groupby(keys)['price'].mean()
+        return self.by(keys, where=where, sort=sort)['price_mean'].rename('price')
+
+    def total(self, where=None):
+        table = self._rows(where)
+        return {
+            'price_mean': table['price_sum'].sum() / table['price_count'].sum(),
+            'price_min': table['price_min'].min(),
+            'price_max': table['price_max'].max(),
+            'count': int(table['price_count'].sum()),
+        }
+
+
+def build_aggregates(df, dimensions=DIMENSIONS):
+    df = df.copy()
+    if 'rooms_cat' not in df.columns:
+        add_rooms_cat(df)
+    df['multi_floor'] = df['floors_count'] > 1
+    # Строковые измерения кодируем категориями: группировка идет по целым кодам
+    keys = [df[d].astype('category') for d in dimensions]
+    values = pd.DataFrame({
+        'price': df['price'].astype('float64'),
+        'ppm2': df['price_per_m2'].astype('float64'),
+    })
+    grain = values.groupby(keys, observed=True, dropna=False, sort=False).agg(
+        price_sum=('price', 'sum'),
+        price_count=('price', 'count'),
+        price_min=('price', 'min'),
+        price_max=('price', 'max'),
+        ppm2_sum=('ppm2', 'sum'),
+        ppm2_count=('ppm2', 'count'),
+        ppm2_min=('ppm2', 'min'),
+        ppm2_max=('ppm2', 'max'),
+    ).reset_index()
+    trimmed = {'price_per_m2_by_type': trimmed_mean(df, 'price_per_m2', 'type_property')}
+    return Aggregates(grain, trimmed)
@@ -1,16 +1,37 @@
 import os
+import sys
 import pandas as pd
 import logging
+import json
 import time
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-# Настройка логов в корневом каталоге проекта BIGdata/logs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage  # noqa: E402
+from instrument import session, span  # noqa: E402
+from parser_city import command_parser  # noqa: E402
+
+# Логи в корневом каталоге проекта BIGdata/logs
 LOG_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../logs'))
-os.makedirs(LOG_DIR, exist_ok=True)
-logging.basicConfig(
-    filename=os.path.join(LOG_DIR, "autotest.log"),
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../'))
+ATEST_DIR = os.path.join(BASE_DIR, "atest")
+METRICS_FILE = os.path.join(LOG_DIR, "autotest_metrics.jsonl")
+REQUIRED_COLS = ["url", "floor", "price", "total_meters", "rooms_count"]
+
+# Эталон: [город_]тип_комнаты..., файл парсера: имя от generate_filename (город_тип_комнаты_(площадь)_время)
+REFERENCE_PATTERN = re.compile(r'^(?:(?P<city>Msk|SPb|NNov)_)?(?P<type>first|second)_(?P<rooms>studio|\d+(?:_\d+)*)')
+RAW_PATTERN = re.compile(r'^(?P<city>[^_]+)_(?P<type>first|second)_(?P<rooms>.+?)_\(\d+(?:\.\d+)?_\d+(?:\.\d+)?\)')
+
+def setup_logging():
+    # Вызывается при запуске автотеста, а не при импорте модуля
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logging.basicConfig(
+        filename=os.path.join(LOG_DIR, "autotest.log"),
+        encoding="utf-8",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
 
 def list_xlsx_files(directory):
     return [f for f in os.listdir(directory) if f.endswith(".xlsx")]
@@ -29,54 +50,209 @@ def choose_file(files, prompt):
         except ValueError:
             print("Введите корректное число.")
 
-def compare_ads(reference_df, test_df):
-    matched = 0
-    mismatched = 0
-    total = 0
-    details = []
+COMPARE_FIELDS = ["floor", "price", "total_meters", "rooms_count"]
+# Допустимое абсолютное расхождение по полю; по умолчанию сравнение точное
+DEFAULT_TOLERANCES = {}
+
+
+def _field_equal(ref_col, test_col, tolerance=0):
+    # Числа сравниваются с допуском, остальное (например "studio") - как строки
+    ref_num = pd.to_numeric(ref_col, errors='coerce')
+    test_num = pd.to_numeric(test_col, errors='coerce')
+    numeric = ref_num.notna() & test_num.notna()
+    equal = numeric & ((ref_num - test_num).abs() <= tolerance)
+    equal |= ref_col.isna() & test_col.isna()
+    as_text = ~numeric & ref_col.notna() & test_col.notna()
+    if as_text.any():
+        equal[as_text] = ref_col[as_text].astype(str) == test_col[as_text].astype(str)
+    return equal.astype(bool)
+
 
-    ref_dict = reference_df.set_index("url").to_dict(orient="index")
-    test_dict = test_df.set_index("url").to_dict(orient="index")
+def compare_frames(reference_df, test_df, fields=COMPARE_FIELDS, tolerances=None):
+    # Сравнение одним join по url вместо цикла по объявлениям
+    tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+    columns = ["url"] + fields
 
-    for url, ref_data in ref_dict.items():
-        total += 1
-        if url not in test_dict:
-            details.append(f"[❌] Не найдено объявление: {url}")
-            mismatched += 1
+    ref = reference_df[columns].dropna(subset=["url"])
+    test = test_df[columns].dropna(subset=["url"])
+    ref_duplicates = int(ref["url"].duplicated().sum())
+    test_duplicates = int(test["url"].duplicated().sum())
+    # При повторах url сравнивается последнее вхождение
+    ref = ref.drop_duplicates("url", keep="last")
+    test = test.drop_duplicates("url", keep="last")
+
+    diff = ref.merge(test, on="url", how="left", suffixes=("_ref", "_test"), indicator=True)
+    found = (diff.pop("_merge") == "both").to_numpy()
+
+    field_mismatches = {}
+    any_mismatch = pd.Series(False, index=diff.index)
+    for field in fields:
+        ok = _field_equal(diff[f"{field}_ref"], diff[f"{field}_test"], tolerances.get(field, 0))
+        mismatch = found & ~ok.to_numpy()
+        diff[f"{field}_ok"] = ~mismatch
+        field_mismatches[field] = int(mismatch.sum())
+        any_mismatch |= mismatch
+
+    diff["status"] = "ok"
+    diff.loc[any_mismatch.to_numpy(), "status"] = "mismatch"
+    diff.loc[~found, "status"] = "missing"
+
+    total = len(diff)
+    matched = int((diff["status"] == "ok").sum())
+    summary = {
+        "total": total,
+        "matched": matched,
+        "mismatched": total - matched,
+        "missing": int((~found).sum()),
+        "field_mismatches": field_mismatches,
+        "duplicate_urls_reference": ref_duplicates,
+        "duplicate_urls_test": test_duplicates,
+        "tolerances": tolerances,
+    }
+    return summary, diff
+
+
+def format_details(diff, fields=COMPARE_FIELDS):
+    details = []
+    for row in diff[diff["status"] != "ok"].itertuples(index=False):
+        row = row._asdict()
+        if row["status"] == "missing":
+            details.append(f"[❌] Не найдено объявление: {row['url']}")
             continue
+        differences = [f"{field}: эталон={row[f'{field}_ref']}, найдено={row[f'{field}_test']}"
+                       for field in fields if not row[f"{field}_ok"]]
+        details.append(f"[⚠️] Несовпадение в {row['url']}:\n    " + "\n    ".join(differences))
+    return details
+
 
-        test_data = test_dict[url]
-        differences = []
-        for field in ["floor", "price", "total_meters", "rooms_count"]:
-            ref_val = ref_data.get(field)
-            test_val = test_data.get(field)
-            if ref_val != test_val:
-                differences.append(f"{field}: эталон={ref_val}, найдено={test_val}")
-
-        if differences:
-            details.append(f"[⚠️] Несовпадение в {url}:\n    " + "\n    ".join(differences))
-            mismatched += 1
+def write_report(summary, diff, path_prefix):
+    # Машиночитаемый отчет: сводка в JSON и строки с расхождениями в CSV
+    with open(f"{path_prefix}.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    diff[diff["status"] != "ok"].to_csv(f"{path_prefix}.csv", index=False, encoding="utf-8")
+    return f"{path_prefix}.json", f"{path_prefix}.csv"
+
+
+def compare_ads(reference_df, test_df, tolerances=None):
+    summary, diff = compare_frames(reference_df, test_df, tolerances=tolerances)
+    return summary["total"], summary["matched"], summary["mismatched"], format_details(diff)
+
+
+def segment_key(filename, pattern):
+    match = pattern.match(os.path.basename(filename))
+    return match.groupdict() if match else None
+
+def pair_files(atest_files, raw_files):
+    # Эталон без города сопоставляется с файлами парсера любого города
+    raw_keys = [(f, segment_key(f, RAW_PATTERN)) for f in raw_files]
+    pairs, unmatched = [], []
+    for ref_file in atest_files:
+        ref_key = segment_key(ref_file, REFERENCE_PATTERN)
+        matches = [
+            f for f, key in raw_keys
+            if ref_key and key and key["type"] == ref_key["type"] and key["rooms"] == ref_key["rooms"]
+            and ref_key["city"] in (None, key["city"])
+        ]
+        if matches:
+            pairs.extend((ref_file, f) for f in matches)
         else:
-            matched += 1
+            unmatched.append(ref_file)
+    return pairs, unmatched
+
+def run_comparison(ref_path, test_path, tolerances=None):
+    # Выполняется в отдельном процессе; возвращает метрики для структурированного лога
+    start_time = time.perf_counter()
+    record = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "reference": os.path.basename(ref_path),
+        "test": os.path.basename(test_path),
+    }
+    try:
+        reference_df = storage.read_table(ref_path)
+        test_df = storage.read_table(test_path)
+        for name, df in (("reference", reference_df), ("test", test_df)):
+            missing = [col for col in REQUIRED_COLS if col not in df.columns]
+            if missing:
+                raise ValueError(f"в файле {record[name]} нет колонок {missing}")
+        compare_start = time.perf_counter()
+        summary, diff = compare_frames(reference_df, test_df, tolerances=tolerances)
+        record["compare_sec"] = round(time.perf_counter() - compare_start, 4)
+        report_name = f"compare_{time.strftime('%Y%m%d_%H%M%S')}_{os.path.splitext(record['reference'])[0]}" \
+                      f"__{os.path.splitext(record['test'])[0]}"
+        json_path, _ = write_report({**record, **summary}, diff, os.path.join(LOG_DIR, report_name))
+        record.update(summary)
+        record.update(rows_reference=len(reference_df), rows_test=len(test_df), report=json_path)
+    except Exception as e:
+        record["error"] = str(e)
+    duration = time.perf_counter() - start_time
+    rows = record.get("rows_reference", 0) + record.get("rows_test", 0)
+    record["duration_sec"] = round(duration, 4)
+    record["rows_per_sec"] = round(rows / duration, 1) if duration > 0 else None
+    return record
 
-    return total, matched, mismatched, details
+def run_batch(workers=None, tolerances=None):
+    start_time = time.time()
+    atest_files = list_xlsx_files(ATEST_DIR)
+    raw_files = storage.list_raw_files()
+    pairs, unmatched = pair_files(atest_files, raw_files)
+
+    logging.info(f"🚀 Пакетный автотест: пар для сравнения {len(pairs)}, эталонов без пары {len(unmatched)}")
+    for ref_file in unmatched:
+        logging.warning(f"Нет файла парсера для эталона: {ref_file}")
+        print(f"⚠️ Нет файла парсера для эталона: {ref_file}")
+    if not pairs:
+        print("❌ Не найдено ни одной пары эталон/файл парсера")
+        return []
+
+    records = []
+    # Сравнения идут в процессах: время и строки каждой пары - в logs/autotest_metrics.jsonl
+    with span("compare_batch", pairs=len(pairs)) as s, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run_comparison, os.path.join(ATEST_DIR, ref_file), test_path, tolerances)
+            for ref_file, test_path in pairs
+        ]
+        with open(METRICS_FILE, "a", encoding="utf-8") as metrics:
+            for future in as_completed(futures):
+                record = future.result()
+                records.append(record)
+                s.add_rows(record.get("rows_reference", 0) + record.get("rows_test", 0))
+                metrics.write(json.dumps(record, ensure_ascii=False) + "\n")
+                if "error" in record:
+                    logging.error(f"{record['reference']} vs {record['test']}: {record['error']}")
+                    print(f"❌ {record['reference']} vs {record['test']}: {record['error']}")
+                    continue
+                logging.info(
+                    f"{record['reference']} vs {record['test']}: совпало {record['matched']} из {record['total']}, "
+                    f"{record['duration_sec']} сек, {record['rows_per_sec']} строк/с"
+                )
+                print(f"{'✅' if record['mismatched'] == 0 else '⚠️'} {record['reference']} vs {record['test']}: "
+                      f"совпало {record['matched']}/{record['total']}, "
+                      f"{record['duration_sec']} сек, {record['rows_per_sec']} строк/с")
+
+    print(f"\n📊 Сравнений: {len(records)}, ошибок: {sum('error' in r for r in records)}, "
+          f"время: {time.time() - start_time:.2f} сек")
+    print(f"📄 Метрики: {METRICS_FILE}")
+    return records
 
-def main():
+def parse_args(argv=None):
+    return command_parser('test').parse_args(argv)
+
+def run_interactive(tolerances=None):
     logging.info("🚀 Запуск автотеста сравнения объявлений")
     start_time = time.time()
 
-    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../'))
-    atest_dir = os.path.join(BASE_DIR, "atest")
-    raw_dir = os.path.join(BASE_DIR, "raw")
+    atest_dir = ATEST_DIR
+    raw_dir = storage.RAW_DIR
 
     atest_files = list_xlsx_files(atest_dir)
-    raw_files = list_xlsx_files(raw_dir)
+    # Файлы парсера: партиции parquet и старые .xlsx, путь относительно raw/
+    raw_files = [os.path.relpath(p, raw_dir) for p in storage.list_raw_files()]
 
     if not atest_files:
         print("❌ В папке 'atest' нет .xlsx файлов")
         return
     if not raw_files:
-        print("❌ В папке 'raw' нет .xlsx файлов")
+        print("❌ В папке 'raw' нет файлов парсера")
         return
 
     ref_file = choose_file(atest_files, "Выберите эталонный файл из папки 'atest':")
@@ -87,13 +263,13 @@ def main():
 
     try:
         reference_df = pd.read_excel(ref_path)
-        test_df = pd.read_excel(test_path)
+        test_df = storage.read_table(test_path)
     except Exception as e:
         logging.error(f"Ошибка при чтении файлов: {e}")
         print(f"❌ Ошибка при чтении файлов: {e}")
         return
 
-    required_cols = ["url", "floor", "price", "total_meters", "rooms_count"]
+    required_cols = REQUIRED_COLS
     if not all(col in reference_df.columns for col in required_cols):
         print(f"❌ Эталонный файл должен содержать колонки: {required_cols}")
         return
@@ -108,11 +284,16 @@ def main():
     logging.info(f"Объявлений в эталонном файле: {len(reference_df)}")
     logging.info(f"Объявлений в проверяемом файле: {len(test_df)}")
 
-    total, matched, mismatched, details = compare_ads(reference_df, test_df)
+    with span("compare") as s:
+        summary, diff = compare_frames(reference_df, test_df, tolerances=tolerances)
+        s.add_rows(len(reference_df) + len(test_df))
+    total, matched, mismatched = summary["total"], summary["matched"], summary["mismatched"]
+    details = format_details(diff)
 
     print(f"🔍 Проверено объявлений: {total}")
     print(f"✅ Совпадают: {matched}")
-    print(f"❌ Не совпадают / не найдены: {mismatched}\n")
+    print(f"❌ Не совпадают / не найдены: {mismatched}")
+    print(f"🔁 Повторов url: эталон={summary['duplicate_urls_reference']}, парсер={summary['duplicate_urls_test']}\n")
     for d in details:
         print(d)
 
@@ -133,5 +314,20 @@ def main():
     for entry in details:
         logging.info(entry)
 
+    report_prefix = os.path.join(LOG_DIR, f"compare_{time.strftime('%Y%m%d_%H%M%S')}")
+    json_path, csv_path = write_report({"reference": ref_file, "test": test_file, **summary}, diff, report_prefix)
+    print(f"\n📄 Отчет: {json_path}, {csv_path}")
+
+def main(args=None):
+    args = args if args is not None else parse_args()
+    setup_logging()
+    # --tolerance price=1000 --tolerance total_meters=0.1 -> {"price": 1000.0, "total_meters": 0.1}
+    tolerances = dict(args.tolerance or [])
+    with session('test', args):
+        if args.batch:
+            run_batch(workers=args.workers, tolerances=tolerances)
+        else:
+            run_interactive(tolerances=tolerances)
+
 if __name__ == "__main__":
     main()
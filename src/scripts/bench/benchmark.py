@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import math
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage  # noqa: E402
+from instrument import session  # noqa: E402
+from parser_city import BENCH_STAGES, command_parser  # noqa: E402
+
+# Воспроизводимые замеры этапов на синтетических данных: сбор (заглушка CianParser), объединение,
+# сравнение с эталоном, фильтры, агрегаты и каждое задание plots.py. Результат - JSON в logs/bench
+BENCH_DIR = os.path.join(storage.BASE_DIR, 'logs', 'bench')
+STAGES = list(BENCH_STAGES)
+DEFAULT_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+# Сбор держит все объявления в памяти словарями, как настоящий парсер - больше 10^5 не гоняем
+CRAWL_MAX_ROWS = 10 ** 5
+MERGE_FILES = 4
+BENCH_FILTERS = """
+// типичный набор правил filters.txt
+area 10..500
+price > 0
+district != Курортный | Кронштадтский
+rooms != 5
+"""
+
+
+@contextlib.contextmanager
+def quiet():
+    # Этапы печатают прогресс и итоги - в замерах они не нужны
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+@contextlib.contextmanager
+def sandbox(root):
+    # Все каталоги хранилища и графиков - во временном каталоге, рабочие данные проекта не трогаем
+    import plots
+
+    saved = (storage.RAW_DIR, storage.PARQUET_DIR, storage.FINAL_DIR, plots.RESULTS_DIR,
+             plots.README_FILENAME, plots.RENDER_CACHE_FILENAME)
+    storage.RAW_DIR = os.path.join(root, 'raw')
+    storage.PARQUET_DIR = os.path.join(storage.RAW_DIR, 'parquet')
+    storage.FINAL_DIR = os.path.join(storage.RAW_DIR, 'final')
+    plots.RESULTS_DIR = os.path.join(root, 'figures')
+    plots.README_FILENAME = os.path.join(plots.RESULTS_DIR, 'readME.txt')
+    plots.RENDER_CACHE_FILENAME = os.path.join(plots.RESULTS_DIR, '.render_cache.json')
+    os.makedirs(plots.RESULTS_DIR, exist_ok=True)
+    try:
+        yield root
+    finally:
+        (storage.RAW_DIR, storage.PARQUET_DIR, storage.FINAL_DIR, plots.RESULTS_DIR,
+         plots.README_FILENAME, plots.RENDER_CACHE_FILENAME) = saved
+
+
+def measure(stage, rows, run, repeat, setup=None):
+    # setup() готовит состояние каждого повтора и в замер не входит
+    runs = []
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        with quiet():
+            start = time.perf_counter()
+            run(state)
+            runs.append(time.perf_counter() - start)
+    best = min(runs)
+    return {
+        "stage": stage,
+        "rows": rows,
+        "runs": [round(r, 6) for r in runs],
+        "best": round(best, 6),
+        "median": round(statistics.median(runs), 6),
+        "rows_per_sec": round(rows / best, 1) if best > 0 else None,
+    }
+
+
+def listings_frame(rows):
+    from bench.synthetic import synthetic_listings
+
+    df = synthetic_listings(rows)
+    df['price_per_m2'] = df['price'] / df['total_meters']
+    return df
+
+
+def bench_crawl(rows, repeat):
+    import parsihka
+    from bench.synthetic import StubCianParser
+
+    # Один сегмент на 75 страниц: объем страницы подбирается под нужное число строк
+    rows_per_page = math.ceil(rows / parsihka.PAGES_PER_SEGMENT)
+    segment = {"city": "Санкт-Петербург", "deal_type": "Вторичка", "rooms": [1], "min_area": 0, "max_area": 300}
+
+    def run(state):
+        parsihka.run_batch([segment], workers=1, min_interval=0,
+                           parser_factory=lambda location: StubCianParser(location, rows_per_page),
+                           stop_on_known=False)
+
+    with tempfile.TemporaryDirectory() as root, sandbox(root):
+        return [measure("crawl", rows_per_page * parsihka.PAGES_PER_SEGMENT, run, repeat)]
+
+
+def bench_merge(rows, repeat):
+    import merge
+
+    with tempfile.TemporaryDirectory() as root, sandbox(root):
+        df = listings_frame(rows).drop(columns=['price_per_m2'])
+        chunk = math.ceil(rows / MERGE_FILES)
+        for i in range(MERGE_FILES):
+            part = df.iloc[i * chunk:(i + 1) * chunk]
+            storage.save_raw(part, f"SPb_second_{i}_(0_300)", "SPb", "second", f"2025050{i + 1}_120000")
+        return [measure("merge", rows, lambda state: merge.merge_excel_files("bench", rebuild=True), repeat)]
+
+
+def bench_compare(rows, repeat):
+    from autotest.auto_test import compare_ads
+    from bench.synthetic import perturb
+
+    reference_df = listings_frame(rows)
+    test_df = perturb(reference_df)
+    return [measure("compare", rows, lambda state: compare_ads(reference_df, test_df), repeat)]
+
+
+def bench_filters(rows, repeat):
+    import plots
+    from filters_engine import FilterSet, parse_rules
+
+    df = listings_frame(rows)
+    filter_set = FilterSet(parse_rules(BENCH_FILTERS), None)
+    return [measure("filters", rows, lambda state: plots.apply_filters(df, filter_set), repeat)]
+
+
+def bench_aggregates(rows, repeat):
+    from aggregates import build_aggregates
+
+    df = listings_frame(rows)
+    return [measure("aggregates", rows, lambda state: build_aggregates(df), repeat)]
+
+
+def bench_plots(rows, repeat):
+    # Каждое задание отдельно: подготовка данных по агрегатам + рисование и сохранение png
+    import plots
+    from aggregates import build_aggregates
+    from filters_engine import FilterSet
+
+    df = listings_frame(rows)
+    dataset = plots.Dataset(df, build_aggregates(df), FilterSet([], None))
+    plots.init_worker()
+    results = []
+    with tempfile.TemporaryDirectory() as root, sandbox(root):
+        for number, (prepare, _) in sorted(plots.TASKS.items()):
+            def run(state, number=number, prepare=prepare):
+                _, _, error = plots.render_task(number, prepare(dataset))
+                if error is not None:
+                    raise RuntimeError(error)
+            results.append(measure(f"plot.task_{number}", rows, run, repeat))
+    return results
+
+
+BENCHMARKS = {
+    'crawl': bench_crawl,
+    'merge': bench_merge,
+    'compare': bench_compare,
+    'filters': bench_filters,
+    'aggregates': bench_aggregates,
+    'plots': bench_plots,
+}
+
+
+def environment():
+    import numpy
+    import pandas
+    import pyarrow
+    import matplotlib
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=storage.BASE_DIR,
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pandas": pandas.__version__,
+        "numpy": numpy.__version__,
+        "pyarrow": pyarrow.__version__,
+        "matplotlib": matplotlib.__version__,
+    }
+
+
+def run_benchmarks(stages=STAGES, sizes=DEFAULT_SIZES, repeat=3):
+    results = []
+    for stage in stages:
+        for rows in sizes:
+            if stage == 'crawl' and rows > CRAWL_MAX_ROWS:
+                continue
+            try:
+                records = BENCHMARKS[stage](rows, repeat)
+            except MemoryError:
+                print(f"⚠️ {stage} на {rows} строк: не хватило памяти")
+                continue
+            for record in records:
+                results.append(record)
+                print(f"⏱ {record['stage']:<14} {record['rows']:>10} строк: {record['best']:.4f} сек "
+                      f"(медиана {record['median']:.4f}), {record['rows_per_sec']} строк/с")
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    # Сравнение лучших времен с прошлым запуском по одинаковым (этап, строки)
+    previous = {(r["stage"], r["rows"]): r["best"] for r in baseline["results"]}
+    regressions = []
+    for record in results:
+        before = previous.get((record["stage"], record["rows"]))
+        if not before:
+            continue
+        ratio = record["best"] / before
+        record["baseline_best"] = before
+        record["ratio"] = round(ratio, 3)
+        if ratio > threshold:
+            regressions.append(record)
+    return regressions
+
+
+def parse_args(argv=None):
+    return command_parser('bench').parse_args(argv)
+
+
+def main(args=None):
+    args = args if args is not None else parse_args()
+    stages = args.stages or STAGES
+    sizes = args.sizes or DEFAULT_SIZES
+
+    print(f"🚀 Бенчмарк: этапы {', '.join(stages)}, строк {sizes}, повторов {args.repeat}")
+    report = {"environment": environment(), "repeat": args.repeat}
+    # С --trace в сводке видны этапы внутри замеров (сами замеры при этом чуть медленнее)
+    with session('bench', args):
+        results = run_benchmarks(stages, sizes, args.repeat)
+    report["results"] = results
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        report["baseline"] = {"path": args.baseline, **baseline["environment"]}
+        regressions = find_regressions(results, baseline, args.threshold)
+
+    output = args.output or os.path.join(BENCH_DIR, f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 Результаты: {output}")
+
+    for record in regressions:
+        print(f"⚠️ Регрессия {record['stage']} на {record['rows']} строк: {record['best']:.4f} сек "
+              f"против {record['baseline_best']:.4f} (x{record['ratio']})")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
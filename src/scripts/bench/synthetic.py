@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+# Синтетические объявления в схеме парсера: распределения похожи на выгрузку по Санкт-Петербургу,
+# значения воспроизводимы при одинаковом seed
+DISTRICTS = ['Адмиралтейский', 'Василеостровский', 'Выборгский', 'Калининский', 'Кировский', 'Колпинский',
+             'Красногвардейский', 'Красносельский', 'Кронштадтский', 'Курортный', 'Московский', 'Невский',
+             'Петроградский', 'Петродворцовый', 'Приморский', 'Пушкинский', 'Фрунзенский', 'Центральный']
+DISTRICT_PRICE = np.linspace(150_000, 400_000, len(DISTRICTS))
+UNDERGROUND = [f"Станция {i}" for i in range(1, 73)]
+STREETS = [f"улица {i}" for i in range(1, 1201)]
+TYPES = ['Вторичка', 'Новостройка']
+ROOMS = np.array([0, 1, 2, 3, 4, 5])
+ROOM_WEIGHTS = np.array([0.12, 0.38, 0.28, 0.14, 0.06, 0.02])
+ROOM_METERS = np.array([25, 38, 58, 80, 105, 140])
+PAGE_SIZE = 28  # объявлений на странице выдачи cian.ru
+
+
+def _categorical(rng, labels, n):
+    return pd.Categorical.from_codes(rng.integers(0, len(labels), n), categories=labels)
+
+
+def synthetic_listings(n, seed=0, first_id=1):
+    rng = np.random.default_rng(seed)
+    district_codes = rng.integers(0, len(DISTRICTS), n)
+    rooms = rng.choice(ROOMS, size=n, p=ROOM_WEIGHTS)
+    meters = np.round(ROOM_METERS[np.searchsorted(ROOMS, rooms)] * rng.uniform(0.7, 1.4, n), 1)
+    floors_count = rng.integers(1, 31, n)
+    floor = (rng.integers(0, 1 << 30, n) % floors_count) + 1
+    price_per_m2 = DISTRICT_PRICE[district_codes] * rng.lognormal(0, 0.25, n)
+    ids = np.arange(first_id, first_id + n)
+    return pd.DataFrame({
+        'url': pd.Series(ids.astype(str), dtype='string').radd('https://spb.cian.ru/sale/flat/').add('/'),
+        'location': 'Санкт-Петербург',
+        'deal_type': 'sale',
+        'type_property': _categorical(rng, TYPES, n),
+        'district': pd.Categorical.from_codes(district_codes, categories=DISTRICTS),
+        'street': _categorical(rng, STREETS, n),
+        'underground': _categorical(rng, UNDERGROUND, n),
+        'floor': floor,
+        'floors_count': floors_count,
+        'rooms_count': rooms,
+        'total_meters': meters,
+        'price': np.round(price_per_m2 * meters, -3).astype('int64'),
+    })
+
+
+def perturb(df, share=0.05, seed=1):
+    # Копия для сравнения с эталоном: у доли объявлений меняется цена
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    changed = rng.random(len(df)) < share
+    df.loc[changed, 'price'] = df.loc[changed, 'price'] + 100_000
+    return df
+
+
+class _PageParser:
+    def __init__(self, end_page):
+        self.result = []
+        self.end_page = end_page
+
+
+class StubCianParser:
+    # Заглушка cianparser.CianParser: страницы синтетических объявлений без сети,
+    # тот же протокол, что использует parsihka.crawl_segment (result, end_page, callback_after_iteration)
+    def __init__(self, location, rows_per_page=PAGE_SIZE):
+        self.location = location
+        self.rows_per_page = rows_per_page
+
+    def get_flats(self, deal_type, rooms, with_saving_csv=False, additional_settings=None):
+        settings = additional_settings or {}
+        callback = settings.get("callback_after_iteration")
+        page = settings.get("start_page", 1)
+        self.__parser__ = _PageParser(settings.get("end_page", page))
+        while page <= self.__parser__.end_page:
+            rows = synthetic_listings(self.rows_per_page, seed=page, first_id=page * self.rows_per_page)
+            self.__parser__.result.extend(rows.astype(object).to_dict('records'))
+            if callback is not None:
+                callback(page)
+            page += 1
+        return self.__parser__.result
@@ -0,0 +1,86 @@
+import storage
+import glob
+import json
+import os
+
+
+def journal_path(raw_dir, base_filename):
+    journal_dir = os.path.join(raw_dir, "journal")
+    os.makedirs(journal_dir, exist_ok=True)
+    return os.path.join(journal_dir, f"{base_filename}.jsonl")
+
+
+def parts_path(raw_dir, base_filename):
+    # Части потоковой записи незавершенного сбора (stream_writer), читаются во время сбора
+    return os.path.join(raw_dir, "journal", f"{base_filename}.parts")
+
+
+class CrawlJournal:
+    # Журнал дописывается построчно: одна строка = одна полностью собранная страница.
+    # В памяти только номера страниц, строки при продолжении читаются с диска по одной странице
+    def __init__(self, path):
+        self.path = path
+        self.pages = set()
+        self.row_count = 0
+        self._truncate_torn_tail()
+        for page, rows in self.replay():
+            self.pages.add(page)
+            self.row_count += len(rows)
+
+    def _truncate_torn_tail(self):
+        # Строка, оборванная при падении процесса, отрезается до конца последней целой строки:
+        # иначе следующие страницы дописывались бы после нее, и replay терял бы их при каждом продолжении
+        if not os.path.exists(self.path):
+            return
+        valid = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+        if valid < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid)
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Последняя строка могла оборваться при падении процесса
+                    break
+                yield record["page"], record["rows"]
+
+    @property
+    def last_page(self):
+        return max(self.pages, default=0)
+
+    def append_page(self, page, rows):
+        self.pages.add(page)
+        self.row_count += len(rows)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"page": page, "rows": rows}, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def stored_urls(base_filename):
+    # url уже сохраненных объявлений этого же сегмента из прошлых запусков
+    urls = set()
+    for path in storage.list_raw_files(f"{glob.escape(base_filename)}_*"):
+        try:
+            urls.update(storage.read_table(path, columns=["url"])["url"].dropna())
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать url из {os.path.basename(path)}: {e}")
+    return urls
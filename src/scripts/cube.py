@@ -0,0 +1,269 @@
+import os
+import glob
+import shutil
+import storage
+import sketches
+import places
+from aggregates import Aggregates
+from instrument import session, span
+from parser_city import CUBE_DIMENSIONS, command_parser
+
+# Куб объявлений: суммы/счетчики/экстремумы цены и цены за м² и скетчи квантилей цены, цены за м²
+# и площади (sketches.py) на самой мелкой сетке измерений. Часть куба - один день запуска парсера:
+# объявление, попавшее за день в несколько файлов (пересекающиеся части сегмента, два запуска),
+# считается один раз, поэтому merge пересобирает только дни новых файлов; загруженный куб отвечает
+# на свертки и срезы группировкой ячеек, без прохода по объявлениям
+CUBE_DIMENSIONS = list(CUBE_DIMENSIONS)
+SKETCH_MEASURES = ['price', 'price_per_m2', 'total_meters']
+LISTING_COLUMNS = ['url', 'source_file', 'location', 'district', 'street', 'underground', 'floor', 'rooms_count',
+                   'type_property', 'price', 'total_meters']
+
+
+def cube_dir(name="merged_data"):
+    return os.path.join(storage.FINAL_DIR, f"{name}.cube")
+
+
+def cells_dir(name="merged_data"):
+    return os.path.join(cube_dir(name), "cells")
+
+
+def sketches_dir(name="merged_data"):
+    return os.path.join(cube_dir(name), "sketches")
+
+
+def day_filename(crawl_date):
+    return f"crawl_date={crawl_date}.parquet"
+
+
+def part_day(filename):
+    return os.path.splitext(filename)[0].split("=", 1)[1]
+
+
+def listing_frame(table, seen_at):
+    # table - часть объединенного набора (storage.listing_table), seen_at - время запуска парсера
+    from aggregates import add_rooms_cat
+    from dedup_index import listing_ids
+
+    df = table.select(LISTING_COLUMNS).to_pandas()
+    df = df.rename(columns={'location': 'city'})
+    df['listing_id'] = listing_ids(df.pop('url'))
+    df['seen_at'] = seen_at
+    df['crawl_date'] = seen_at[:10]
+    add_rooms_cat(df)
+    meters = df['total_meters'].where(df['total_meters'] > 0)
+    df['price'] = df['price'].astype('float64')
+    df['price_per_m2'] = (df['price'] / meters).astype('float64')
+    return df
+
+
+def latest_listings(df):
+    # Объявление, встреченное за день несколько раз, - одна строка с последним наблюдением
+    # (как в dedup_index и price_history.price_index); строки без ссылки не сравниваются
+    import pandas as pd
+
+    df = df.sort_values(['seen_at', 'source_file'], kind='stable')
+    known = df['listing_id'].notna()
+    return pd.concat([df[known].drop_duplicates(['crawl_date', 'listing_id'], keep='last'), df[~known]],
+                     ignore_index=True)
+
+
+def cube_part(df):
+    # Ячейки и длинная таблица скетчей по кадру listing_frame (уже без повторов объявлений)
+    import pandas as pd
+
+    keys = df[CUBE_DIMENSIONS]
+    cells = df.groupby(CUBE_DIMENSIONS, observed=True, dropna=False, sort=False).agg(
+        listings=('price', 'size'),
+        price_sum=('price', 'sum'),
+        price_count=('price', 'count'),
+        price_min=('price', 'min'),
+        price_max=('price', 'max'),
+        ppm2_sum=('price_per_m2', 'sum'),
+        ppm2_count=('price_per_m2', 'count'),
+        ppm2_min=('price_per_m2', 'min'),
+        ppm2_max=('price_per_m2', 'max'),
+    ).reset_index()
+    sketch = pd.concat([sketches.sketch(keys, df[measure], measure) for measure in SKETCH_MEASURES],
+                       ignore_index=True)
+    return cells, sketch
+
+
+def day_part(parts):
+    # Часть куба одного дня по частям объединенного набора: parts - [(путь части, время запуска)].
+    # Выполняется и в процессах merge: читаются только нужные колонки
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    frames = [listing_frame(pq.read_table(path, columns=LISTING_COLUMNS), seen_at) for path, seen_at in parts]
+    return cube_part(latest_listings(pd.concat(frames, ignore_index=True)))
+
+
+def write_part(name, crawl_date, part):
+    # Части ячеек и скетчей называются одинаково; part - cube_part/day_part дня.
+    # Возвращается имя части для манифеста
+    filename = day_filename(crawl_date)
+    cells, sketch = part
+    for directory, frame in ((cells_dir(name), cells), (sketches_dir(name), sketch)):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename)
+        frame.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+    return filename
+
+
+def remove_part(name, filename):
+    for directory in (cells_dir(name), sketches_dir(name)):
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def clear(name="merged_data"):
+    shutil.rmtree(cube_dir(name), ignore_errors=True)
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+
+
+class Cube(Aggregates):
+    # Свертка (by/mean/total) - как у Aggregates, плюс срезы по значениям измерений и квантили из скетчей
+    def __init__(self, cells, sketch):
+        super().__init__(cells, {})
+        self.sketch = sketch
+
+    def __len__(self):
+        return len(self.grain)
+
+    def slice(self, start=None, end=None, **where):
+        # where: измерение=значение или список значений; start/end - даты запуска 'YYYY-MM-DD' включительно
+        unknown = [dimension for dimension in where if dimension not in CUBE_DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Измерения куба: {', '.join(CUBE_DIMENSIONS)}; неизвестные: {', '.join(unknown)}")
+
+        # Районы, улицы и метро сравниваются по ключам названий: "Приморский район" - это "Приморский"
+        values = {}
+        for dimension, value in where.items():
+            value = _as_list(value)
+            if dimension in places.PLACE_FIELDS:
+                keys = {places.name_key(dimension, v) for v in value}
+                value = [name for name in self.grain[dimension].cat.categories
+                         if places.name_key(dimension, name) in keys]
+            values[dimension] = value
+
+        def mask(table):
+            keep = None
+            for dimension, value in values.items():
+                match = table[dimension].isin(value)
+                keep = match if keep is None else keep & match
+            for bound, compare in ((start, 'ge'), (end, 'le')):
+                if bound is not None:
+                    match = getattr(table['crawl_date'].astype(str), compare)(bound)
+                    keep = match if keep is None else keep & match
+            return keep
+
+        if not where and start is None and end is None:
+            return self
+        return Cube(self.grain[mask(self.grain).to_numpy()], self.sketch[mask(self.sketch).to_numpy()])
+
+    def rollup(self, keys, sort=True):
+        # Свертка до ключей keys; итог по всему срезу - total()
+        return self.by(list(keys), sort=sort)
+
+    def _sketch(self, measure):
+        if measure not in SKETCH_MEASURES:
+            raise ValueError(f"Скетчи есть для {', '.join(SKETCH_MEASURES)}, передано: {measure}")
+        return self.sketch[self.sketch['measure'] == measure]
+
+    def quantile(self, keys=(), q=0.5, measure='price_per_m2'):
+        # Квантиль по скетчам: в пределах sketches.RELATIVE_ACCURACY от точного значения
+        return sketches.quantiles(self._sketch(measure), list(keys), q)
+
+    def trimmed_mean(self, keys=(), measure='price_per_m2', lower=0.05, upper=0.95):
+        # Среднее без выбросов за квантилями lower/upper каждой группы, как aggregates.trimmed_mean
+        return sketches.trimmed_means(self._sketch(measure), list(keys), lower, upper)
+
+
+def _read_parts(directory):
+    import pandas as pd
+
+    parts = sorted(glob.glob(os.path.join(directory, "*.parquet")))
+    if not parts:
+        return None
+    return pd.concat([pd.read_parquet(path) for path in parts], ignore_index=True)
+
+
+def load_cube(name="merged_data"):
+    # Ячейки и корзины складываются: варианты названий после нормализации - одна ячейка.
+    # Дни не пересекаются, и свертка по нескольким дням учитывает объявление в каждом дне, где оно было
+    with span("load_cube", dataset=name) as s:
+        cells = _read_parts(cells_dir(name))
+        sketch = _read_parts(sketches_dir(name))
+        if cells is None:
+            raise FileNotFoundError(f"Не найден куб {cube_dir(name)}. Запустите merge.py")
+        for dimension in CUBE_DIMENSIONS:
+            if dimension != 'floor':
+                cells[dimension] = cells[dimension].astype('category')
+                sketch[dimension] = sketch[dimension].astype('category')
+        # Названия приводятся к каноническим при загрузке - это касается и частей, записанных раньше
+        places.normalize_places(cells)
+        places.normalize_places(sketch)
+        cells = cells.groupby(CUBE_DIMENSIONS, observed=True, dropna=False, sort=False).agg(
+            listings=('listings', 'sum'),
+            price_sum=('price_sum', 'sum'),
+            price_count=('price_count', 'sum'),
+            price_min=('price_min', 'min'),
+            price_max=('price_max', 'max'),
+            ppm2_sum=('ppm2_sum', 'sum'),
+            ppm2_count=('ppm2_count', 'sum'),
+            ppm2_min=('ppm2_min', 'min'),
+            ppm2_max=('ppm2_max', 'max'),
+        ).reset_index()
+        sketch = sketches.merge_sketches(sketch, CUBE_DIMENSIONS)
+        s.add_rows(len(cells))
+    return Cube(cells, sketch)
+
+
+def parse_args(argv=None):
+    return command_parser('cube').parse_args(argv)
+
+
+def main(args=None):
+    import time
+    import pandas as pd
+
+    args = args if args is not None else parse_args()
+    with session('cube', args):
+        try:
+            cube = load_cube(args.output)
+        except FileNotFoundError as e:
+            print(f"❌ {e}")
+            return
+        start_time = time.perf_counter()
+        where = {}
+        for dimension, value in args.where or []:
+            where.setdefault(dimension, []).append(value)
+        view = cube.slice(start=args.start, end=args.end, **where)
+        if view.grain.empty:
+            print("❌ В срезе нет объявлений")
+            return
+        if args.by:
+            table = view.rollup(args.by)
+            columns = ['price_count', 'price_min', 'price_max', 'price_mean', 'ppm2_mean']
+            for q in args.quantile or [0.5]:
+                columns.append(f"{args.measure}_q{q:g}")
+                table[columns[-1]] = view.quantile(args.by, q, measure=args.measure)
+            if args.trimmed:
+                columns.append(f"{args.measure}_trimmed")
+                table[columns[-1]] = view.trimmed_mean(args.by, measure=args.measure)
+        else:
+            table = pd.DataFrame([view.total()])
+            columns = list(table.columns)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+    with pd.option_context('display.width', 200, 'display.max_columns', 50, 'display.max_rows', 200):
+        print(f"🧊 Куб {cube_dir(args.output)}: {len(cube)} ячеек, запрос {elapsed_ms:.1f} мс")
+        print(table[columns].round(0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import pandas as pd
+import hashlib
+import sqlite3
+import time
+import re
+import os
+import storage
+
+# https://spb.cian.ru/sale/flat/314345245/ -> 314345245
+LISTING_ID_PATTERN = r'/(\d+)/?(?:[?#].*)?$'
+CRAWL_TIME_PATTERN = re.compile(r'_(\d{8})_(\d{6})\.[^.]+$')
+# Колонки, которые load_deduplicated добавляет к объявлениям
+DEDUP_COLUMNS = ['listing_id', 'first_seen', 'last_seen', 'seen_count']
+
+
+def index_path(name="merged_data"):
+    return os.path.join(storage.FINAL_DIR, f"{name}.dedup.sqlite")
+
+
+def _url_hash(url):
+    # Для ссылок без числового id - устойчивый 63-битный хэш (отрицательный, чтобы не пересекаться с id)
+    digest = hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest()
+    return -(int.from_bytes(digest, 'big') >> 1) - 1
+
+
+def listing_ids(urls):
+    urls = pd.Series(urls, dtype='string')
+    ids = pd.to_numeric(urls.str.extract(LISTING_ID_PATTERN, expand=False), errors='coerce').astype('Int64')
+    missing = ids.isna() & urls.notna()
+    if missing.any():
+        ids[missing] = [_url_hash(url) for url in urls[missing]]
+    return ids
+
+
+def crawl_time(source_file, default=None):
+    # Время запуска парсера из имени файла (..._20250523_001955.xlsx), иначе default
+    match = CRAWL_TIME_PATTERN.search(source_file)
+    if match is None:
+        return default
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(match.group(1) + match.group(2), "%Y%m%d%H%M%S"))
+
+
+class DedupIndex:
+    # Индекс объявлений по listing_id: где лежит последнее наблюдение и когда объявление встречалось.
+    # Наблюдения хранятся по (listing_id, source_file): повторное объединение того же или измененного
+    # файла заменяет его наблюдения, а не добавляет их еще раз; listings пересчитывается из наблюдений
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS listings ("
+            " listing_id INTEGER PRIMARY KEY,"
+            " url TEXT,"
+            " first_seen TEXT,"
+            " last_seen TEXT,"
+            " seen_count INTEGER,"
+            " source_file TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS observations ("
+            " listing_id INTEGER,"
+            " source_file TEXT,"
+            " seen_at TEXT,"
+            " url TEXT,"
+            " PRIMARY KEY (listing_id, source_file)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS observations_file ON observations (source_file)")
+
+    def needs_backfill(self):
+        # Индекс, собранный до таблицы наблюдений: счетчики в listings нельзя пересчитать
+        has_listings = self.conn.execute("SELECT 1 FROM listings LIMIT 1").fetchone() is not None
+        has_observations = self.conn.execute("SELECT 1 FROM observations LIMIT 1").fetchone() is not None
+        return has_listings and not has_observations
+
+    def add(self, urls, source_file, seen_at):
+        # Наблюдения файла заменяются целиком; пересчитываются только затронутые объявления
+        ids = listing_ids(urls)
+        rows = {}
+        for listing_id, url in zip(ids, urls):
+            if pd.notna(listing_id):
+                rows[int(listing_id)] = url
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS touched (listing_id INTEGER PRIMARY KEY)")
+        self.conn.execute("DELETE FROM touched")
+        self.conn.execute("INSERT OR IGNORE INTO touched SELECT listing_id FROM observations WHERE source_file = ?",
+                          (source_file,))
+        self.conn.execute("DELETE FROM observations WHERE source_file = ?", (source_file,))
+        self.conn.executemany(
+            "INSERT INTO observations (listing_id, source_file, seen_at, url) VALUES (?, ?, ?, ?)",
+            ((listing_id, source_file, seen_at, url) for listing_id, url in rows.items())
+        )
+        self.conn.executemany("INSERT OR IGNORE INTO touched VALUES (?)", ((listing_id,) for listing_id in rows))
+        self._refresh()
+        return len(rows)
+
+    def _refresh(self):
+        # Последнее наблюдение - самое позднее по времени запуска (при равенстве - по имени файла)
+        self.conn.execute("DELETE FROM listings WHERE listing_id IN (SELECT listing_id FROM touched)")
+        self.conn.execute(
+            "INSERT INTO listings (listing_id, url, first_seen, last_seen, seen_count, source_file)"
+            " SELECT listing_id, url, first_seen, seen_at, seen_count, source_file FROM ("
+            "  SELECT listing_id, url, seen_at, source_file,"
+            "   MIN(seen_at) OVER w AS first_seen, COUNT(*) OVER w AS seen_count,"
+            "   ROW_NUMBER() OVER (PARTITION BY listing_id ORDER BY seen_at DESC, source_file DESC) AS position"
+            "  FROM observations WHERE listing_id IN (SELECT listing_id FROM touched)"
+            "  WINDOW w AS (PARTITION BY listing_id))"
+            " WHERE position = 1"
+        )
+
+    def clear(self):
+        self.conn.execute("DELETE FROM listings")
+        self.conn.execute("DELETE FROM observations")
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+
+    def history(self, url):
+        listing_id = int(listing_ids([url]).iloc[0])
+        row = self.conn.execute(
+            "SELECT listing_id, url, first_seen, last_seen, seen_count, source_file FROM listings WHERE listing_id = ?",
+            (listing_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["listing_id", "url", "first_seen", "last_seen", "seen_count", "source_file"], row))
+
+    def latest(self):
+        df = pd.read_sql_query(
+            "SELECT listing_id, first_seen, last_seen, seen_count, source_file FROM listings", self.conn
+        )
+        df['listing_id'] = df['listing_id'].astype('Int64')
+        df['source_file'] = df['source_file'].astype('string')
+        return df
+
+
+def load_deduplicated(name="merged_data", columns=None):
+    # Оставляем по каждому объявлению только строку из файла с последним наблюдением.
+    # Набор без индекса дублей (старая выгрузка в один файл) - последняя строка каждого объявления
+    load_columns = None if columns is None else list(dict.fromkeys(list(columns) + ['url', 'source_file']))
+    df = storage.load_listings(name, columns=load_columns)
+    df['listing_id'] = listing_ids(df['url'])
+    if os.path.exists(index_path(name)):
+        index = DedupIndex(index_path(name))
+        try:
+            latest = index.latest()
+        finally:
+            index.close()
+        df = df.merge(latest, on=['listing_id', 'source_file'], how='inner')
+    # Повторы внутри одного файла (пересекающиеся страницы выдачи); строки без url не сливаются
+    duplicated = df.duplicated('listing_id', keep='last') & df['listing_id'].notna()
+    df = df[~duplicated].reset_index(drop=True)
+    return df if columns is None else df[list(columns)]
@@ -0,0 +1,180 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import re
+
+# Короткие имена полей в filters.txt
+FIELD_ALIASES = {
+    'rooms': 'rooms_count',
+    'area': 'total_meters',
+    'floors': 'floors_count',
+    'type': 'type_property',
+}
+NUMERIC_FIELDS = {'rooms_count', 'total_meters', 'floors_count', 'price', 'price_per_m2', 'floor'}
+KNOWN_FIELDS = NUMERIC_FIELDS | {'district', 'street', 'underground', 'type_property', 'rooms_cat', 'location'}
+
+RULE_PATTERN = re.compile(r'^(?P<field>[a-z_0-9]+)\s*(?P<op>!=|<=|>=|=|<|>)\s*(?P<value>.+)$')
+RANGE_PATTERN = re.compile(r'^(?P<field>[a-z_0-9]+)\s+(?P<low>[-\d.]+)\s*\.\.\s*(?P<high>[-\d.]+)$')
+LEGACY_ROOMS_SUFFIX = ' комн. кв-ра'
+
+# Разобранные файлы фильтров по sha256 содержимого
+_CACHE = {}
+
+
+class Rule:
+    def __init__(self, sections, field, op, values, line_number, text):
+        self.sections = sections
+        self.field = field
+        self.op = op
+        self.values = values
+        self.line_number = line_number
+        self.text = text
+
+    def __repr__(self):
+        return f"стр. {self.line_number}: {self.text}"
+
+
+def _parse_sections(header):
+    # "#5" -> {"5"}, "#5, 6." -> {"5", "6"}, "#all" -> None (общие правила)
+    names = {part.strip().strip('.').strip() for part in header.strip('#').split(',')}
+    names.discard('')
+    if not names or names & {'all', '*'}:
+        return None
+    return frozenset(names)
+
+
+def _parse_value(field, value):
+    return float(value) if field in NUMERIC_FIELDS else value
+
+
+def parse_rules(text):
+    rules = []
+    sections = None
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith('//'):
+            continue
+        if line.startswith('#'):
+            sections = _parse_sections(line)
+            continue
+
+        match = RANGE_PATTERN.match(line)
+        if match:
+            field = FIELD_ALIASES.get(match['field'], match['field'])
+            if field not in NUMERIC_FIELDS:
+                raise ValueError(f"стр. {line_number}: диапазон допустим только для числовых полей: {line}")
+            rules.append(Rule(sections, field, 'range', (float(match['low']), float(match['high'])), line_number, line))
+            continue
+
+        match = RULE_PATTERN.match(line)
+        if match and FIELD_ALIASES.get(match['field'], match['field']) in KNOWN_FIELDS:
+            field = FIELD_ALIASES.get(match['field'], match['field'])
+            op = match['op']
+            if op in ('=', '!='):
+                values = tuple(_parse_value(field, v.strip()) for v in match['value'].split('|'))
+            elif field in NUMERIC_FIELDS:
+                values = (float(match['value']),)
+            else:
+                raise ValueError(f"стр. {line_number}: сравнение {op} допустимо только для числовых полей: {line}")
+            rules.append(Rule(sections, field, op, values, line_number, line))
+            continue
+
+        # Старый формат: "N комн. кв-ра..." - убрать такие квартиры, иначе - название района
+        if 'комн' in line:
+            rules.append(Rule(sections, 'rooms_count', 'legacy_rooms', (line.split('!')[0].strip(),), line_number, line))
+        else:
+            rules.append(Rule(sections, 'district', '!=', (line,), line_number, line))
+    return rules
+
+
+class FilterSet:
+    def __init__(self, rules, digest):
+        self.rules = rules
+        self.digest = digest
+
+    def section(self, section=None):
+        # section=None - общие правила, иначе - правила конкретного задания
+        if section is None:
+            return [r for r in self.rules if r.sections is None]
+        return [r for r in self.rules if r.sections is not None and str(section) in r.sections]
+
+    def fields(self, section=None):
+        return {r.field for r in self.section(section)}
+
+    def mask(self, df, section=None, weights=None):
+        # Одна итоговая маска "оставить строку" и число строк, отброшенных каждым правилом.
+        # Все исключения по одному полю сводятся в одно множество кодов категорий.
+        # weights - сколько объявлений за каждой строкой df (сетка агрегатов): отброшенные считаются в объявлениях
+        weights = np.ones(len(df)) if weights is None else np.asarray(weights, dtype='float64')
+        if 'rooms_cat' in self.fields(section) and 'rooms_cat' not in df.columns:
+            # Категория комнат появляется в aggregates - у строк набора ее выводим из rooms_count
+            from aggregates import add_rooms_cat
+
+            df = df.assign(rooms_cat=add_rooms_cat(df[['rooms_count']].copy())['rooms_cat'].to_numpy())
+        keep = np.ones(len(df), dtype=bool)
+        hits = {}
+        excluded = {}
+        for rule in self.section(section):
+            if rule.op in ('!=', 'legacy_rooms'):
+                excluded.setdefault(rule.field, []).append(rule)
+                continue
+            rule_keep = self._rule_keep(rule, df)
+            hits[rule] = int(round(weights[~rule_keep].sum()))
+            keep &= rule_keep
+
+        for field, rules in excluded.items():
+            cat = df[field].astype('category').cat
+            codes = cat.codes.to_numpy()
+            counts = np.bincount(codes[codes >= 0], weights=weights[codes >= 0], minlength=len(cat.categories))
+            all_codes = []
+            for rule in rules:
+                rule_codes = self._matched_codes(rule, cat.categories)
+                hits[rule] = int(round(counts[rule_codes].sum()))
+                all_codes.extend(rule_codes)
+            keep &= ~np.isin(codes, all_codes)
+        hits = dict(sorted(hits.items(), key=lambda item: item[0].line_number))
+        return keep, hits
+
+    def apply(self, df, section=None):
+        keep, hits = self.mask(df, section)
+        return df[keep], hits
+
+    @staticmethod
+    def _matched_codes(rule, categories):
+        if rule.op == 'legacy_rooms':
+            labels = [f"{value}{LEGACY_ROOMS_SUFFIX}" for value in categories]
+            return [i for i, label in enumerate(labels) if rule.values[0] in label]
+        codes = categories.get_indexer(list(rule.values))
+        return codes[codes >= 0].tolist()
+
+    @classmethod
+    def _rule_keep(cls, rule, df):
+        column = df[rule.field]
+        if rule.op == '=':
+            # Принадлежность множеству - по целым кодам категорий
+            cat = column.astype('category').cat
+            return np.isin(cat.codes.to_numpy(), cls._matched_codes(rule, cat.categories))
+        values = pd.to_numeric(column, errors='coerce').astype('float64').to_numpy()
+        if rule.op == 'range':
+            low, high = rule.values
+            return (values >= low) & (values <= high)
+        threshold = rule.values[0]
+        return {
+            '<': values < threshold,
+            '<=': values <= threshold,
+            '>': values > threshold,
+            '>=': values >= threshold,
+        }[rule.op]
+
+
+def load_filters(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if digest not in _CACHE:
+        _CACHE[digest] = FilterSet(parse_rules(content.decode('utf-8')), digest)
+    return _CACHE[digest]
+
+
+def format_hits(hits):
+    return [f"  {rule}: убрано {count} строк" for rule, count in hits.items()]
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+# Инструментирование запусков: вложенные этапы (span), счетчики строк, пик RSS каждого этапа,
+# по желанию - cProfile/pyinstrument. Включается флагом --trace/--profile любой команды
+# или переменными окружения; выключенное стоит одну проверку на этап.
+# Только стандартная библиотека: модуль подключают storage и все команды
+LOG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'logs')
+TRACE_ENV = 'PARSER_CITY_TRACE'
+PROFILE_ENV = 'PARSER_CITY_PROFILE'
+CLEAR_REFS = '/proc/self/clear_refs'
+PROC_STATUS = '/proc/self/status'
+
+# Активная сессия трассировки (одна на процесс)
+_session = None
+
+
+def _peak_rss_kb():
+    # Пик RSS процесса с последнего сброса (Linux: VmHWM), иначе - пик за все время процесса
+    try:
+        with open(PROC_STATUS, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _reset_peak_rss():
+    # Запись "5" в clear_refs сбрасывает VmHWM до текущего RSS - так пик считается для каждого этапа.
+    # Счетчик один на процесс: сброс из параллельного потока портил бы пик чужих этапов
+    try:
+        with open(CLEAR_REFS, 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class Span:
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.parent = parent
+        self.path = f"{parent.path}/{name}" if parent is not None else name
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.attrs = attrs
+        self.rows = 0
+        self.peak_rss_kb = None
+        self.error = None
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def add_rows(self, count):
+        self.rows += int(count)
+
+    def update_peak(self, peak_kb):
+        if peak_kb is not None:
+            self.peak_rss_kb = peak_kb if self.peak_rss_kb is None else max(self.peak_rss_kb, peak_kb)
+
+
+class _NullSpan:
+    def add_rows(self, count):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class TraceSession:
+    def __init__(self, command, trace_path):
+        self.command = command
+        self.run_id = f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        self.trace_path = trace_path
+        self.records = []
+        self._first_start = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = open(trace_path, 'a', encoding='utf-8') if trace_path else None
+
+    def stack(self):
+        # У каждого потока свой стек этапов (parsihka собирает сегменты в нескольких потоках)
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def record(self, current):
+        record = {
+            "run": self.run_id,
+            "command": self.command,
+            "span": current.path,
+            "depth": current.depth,
+            "thread": threading.current_thread().name,
+            "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(current.started_at)),
+            "duration_sec": round(current.duration, 6),
+            "rows": current.rows,
+            "rows_per_sec": round(current.rows / current.duration, 1) if current.rows and current.duration > 0 else None,
+            "peak_rss_mb": round(current.peak_rss_kb / 1024, 1) if current.peak_rss_kb is not None else None,
+        }
+        if current.attrs:
+            record["attrs"] = current.attrs
+        if current.error:
+            record["error"] = current.error
+        with self._lock:
+            self.records.append(record)
+            self._first_start[current.path] = min(current.started_at,
+                                                  self._first_start.get(current.path, current.started_at))
+            if self._file is not None:
+                self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def summary(self):
+        # Этапы с одинаковым путем складываются: число вызовов, время, строки, наибольший пик
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["span"], {"depth": record["depth"], "calls": 0, "seconds": 0.0,
+                                                       "rows": 0, "peak_rss_mb": None})
+            total["calls"] += 1
+            total["seconds"] += record["duration_sec"]
+            total["rows"] += record["rows"]
+            if record["peak_rss_mb"] is not None:
+                total["peak_rss_mb"] = max(total["peak_rss_mb"] or 0, record["peak_rss_mb"])
+        lines = [f"{'Этап':<44} {'вызовов':>7} {'сек':>9} {'строк':>10} {'строк/с':>11} {'пик RSS, МБ':>12}"]
+        # Порядок - по началу этапа: родитель раньше вложенных
+        for path, total in sorted(totals.items(), key=lambda item: (self._first_start[item[0]], item[0])):
+            name = "  " * total["depth"] + path.rsplit("/", 1)[-1]
+            speed = f"{total['rows'] / total['seconds']:.0f}" if total["rows"] and total["seconds"] > 0 else "-"
+            peak = f"{total['peak_rss_mb']:.1f}" if total["peak_rss_mb"] is not None else "-"
+            lines.append(f"{name:<44} {total['calls']:>7} {total['seconds']:>9.3f} {total['rows'] or '-':>10} "
+                         f"{speed:>11} {peak:>12}")
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def span(name, /, **attrs):
+    # with span("merge.write_part", file=file) as s: ...; s.add_rows(len(df))
+    session = _session
+    if session is None:
+        yield NULL_SPAN
+        return
+    stack = session.stack()
+    parent = stack[-1] if stack else None
+    # Пик RSS - общий на процесс, поэтому его меряют и сбрасывают только этапы главного потока;
+    # у этапов рабочих потоков (сегменты parsihka) пика нет, их память входит в пик этапа главного потока
+    measure_rss = threading.current_thread() is threading.main_thread()
+    if measure_rss:
+        if parent is not None:
+            # Пик родителя до начала вложенного этапа, затем счетчик сбрасывается для нового этапа
+            parent.update_peak(_peak_rss_kb())
+        _reset_peak_rss()
+    current = Span(name, parent, attrs)
+    stack.append(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        stack.pop()
+        if measure_rss:
+            current.update_peak(_peak_rss_kb())
+        if parent is not None:
+            parent.update_peak(current.peak_rss_kb)
+        session.record(current)
+
+
+def enabled():
+    return _session is not None
+
+
+@contextlib.contextmanager
+def _profiler(kind, command, stamp):
+    if kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("⚠️ pyinstrument не установлен (pip install pyinstrument), используется cProfile")
+            kind = 'cprofile'
+    if kind == 'pyinstrument':
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            path = os.path.join(LOG_DIR, f"profile_{command}_{stamp}.html")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(profiler.output_html())
+            print(profiler.output_text(unicode=True))
+            print(f"📄 Профиль: {path}")
+        return
+
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = os.path.join(LOG_DIR, f"profile_{command}_{stamp}.prof")
+        profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(15)
+        print(f"📄 Профиль: {path} (snakeviz/pstats)")
+
+
+@contextlib.contextmanager
+def session(command, args=None):
+    # Обертка запуска команды: без --trace/--profile ничего не делает
+    global _session
+    trace = getattr(args, 'trace', False) or os.environ.get(TRACE_ENV, '') not in ('', '0')
+    profile = getattr(args, 'profile', None) or os.environ.get(PROFILE_ENV) or None
+    if _session is not None or not (trace or profile):
+        with span(command):
+            yield
+        return
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    trace_path = os.path.join(LOG_DIR, f"trace_{command}_{stamp}.jsonl") if trace else None
+    _session = TraceSession(command, trace_path)
+    try:
+        with contextlib.ExitStack() as stack:
+            if profile:
+                stack.enter_context(_profiler(profile, command, stamp))
+            stack.enter_context(span(command))
+            yield
+    finally:
+        current, _session = _session, None
+        current.close()
+        if trace:
+            print(f"\n📊 Этапы запуска {command}:")
+            print(current.summary())
+            print(f"📄 Трассировка: {trace_path}")
@@ -1,48 +1,305 @@
-import pandas as pd
 import os
-from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+import hashlib
+import shutil
+import json
 import time
+import storage
+import price_history
+from instrument import session, span
+from parser_city import command_parser
 
 
-def merge_excel_files(output_filename="merged_data.xlsx"):
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(output_filename):
+    return os.path.join(storage.FINAL_DIR, f"{output_filename}.manifest.json")
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    # Пишем во временный файл и подменяем, чтобы манифест не остался обрезанным
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def find_new_files(raw_files, manifest):
+    # Новые или измененные файлы; размер и mtime проверяем до подсчета хэша
+    new_files = []
+    for file_path in raw_files:
+        file = os.path.basename(file_path)
+        stat = os.stat(file_path)
+        entry = manifest.get(file)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            continue
+        sha256 = file_sha256(file_path)
+        if entry and entry["sha256"] == sha256:
+            entry["mtime"] = stat.st_mtime
+            continue
+        new_files.append((file_path, stat, sha256))
+    return new_files
+
+
+def seen_time(file, mtime):
+    # Время запуска парсера из имени файла, иначе - время изменения файла
+    from dedup_index import crawl_time
+
+    return crawl_time(file, default=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime)))
+
+
+def read_raw_file(file_path):
+    # Выполняется в процессе-обработчике: разбор файла и перевод в колонки Arrow
+    file = os.path.basename(file_path)
+    try:
+        df = storage.read_table(file_path)
+        df['source_file'] = file  # добавить имя файла
+        table = storage.listing_table(df)
+        del df
+        return file, table, None
+    except Exception as e:
+        return file, None, str(e)
+
+
+def read_raw_files(file_paths, workers=1):
+    # Результаты отдаются по мере готовности; в работе не больше 2 * workers файлов,
+    # чтобы память не росла с числом файлов
+    if workers <= 1:
+        for file_path in file_paths:
+            yield file_path, read_raw_file(file_path)
+        return
+
+    pending = iter(file_paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for file_path in islice(pending, workers * 2):
+            futures[executor.submit(read_raw_file, file_path)] = file_path
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path = futures.pop(future)
+                yield file_path, future.result()
+            for file_path in islice(pending, len(done)):
+                futures[executor.submit(read_raw_file, file_path)] = file_path
+
+
+def backfill_parts(manifest, output_filename):
+    # Файлы, объединенные до появления истории цен или дневных частей куба: наблюдения берутся
+    # из уже записанных частей, сырые файлы заново не читаются.
+    # Возвращает число дополненных файлов и дни, куб которых надо пересобрать
+    import pyarrow.parquet as pq
+    import cube
+
+    dataset_dir = storage.merged_dataset_dir(output_filename)
+    added = 0
+    days = set()
+    for file, entry in manifest.items():
+        part = os.path.join(dataset_dir, entry["part"])
+        if not os.path.exists(part):
+            continue
+        seen_at = seen_time(file, entry["mtime"])
+        if not entry.get("history"):
+            part_id = os.path.splitext(entry["part"])[0][len("part-"):]
+            entry["history"] = price_history.append_observations(pq.read_table(part), output_filename, part_id,
+                                                                 seen_at)
+            added += 1
+        old_part = entry.get("cube") or ""
+        if old_part != cube.day_filename(seen_at[:10]):
+            # Часть куба на файл (до дневных частей) считала повторы объявлений за день дважды
+            if old_part.startswith("part-"):
+                cube.remove_part(output_filename, old_part)
+            elif old_part:
+                days.add(cube.part_day(old_part))
+            days.add(seen_at[:10])
+    return added, days
+
+
+def build_cube_days(jobs, workers=1):
+    # jobs - [(день, [(путь части набора, время запуска)])]; дни считаются в workers процессах
+    import cube
+
+    if workers <= 1 or len(jobs) <= 1:
+        for day, parts in jobs:
+            yield day, cube.day_part(parts)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        yield from zip([day for day, _ in jobs], executor.map(cube.day_part, [parts for _, parts in jobs]))
+
+
+def update_cube(manifest, output_filename, days, workers=1):
+    # День пересобирается целиком из частей всех своих файлов: объявление, попавшее за день
+    # в несколько файлов, считается в кубе один раз. Остальные дни не пересчитываются
+    import cube
+
+    dataset_dir = storage.merged_dataset_dir(output_filename)
+    files = {day: [] for day in days}
+    for file, entry in manifest.items():
+        seen_at = seen_time(file, entry["mtime"])
+        part = os.path.join(dataset_dir, entry["part"])
+        if seen_at[:10] in files and os.path.exists(part):
+            files[seen_at[:10]].append((file, part, seen_at))
+    jobs = []
+    for day, day_files in sorted(files.items()):
+        if day_files:
+            jobs.append((day, [(part, seen_at) for _, part, seen_at in day_files]))
+        else:
+            cube.remove_part(output_filename, cube.day_filename(day))
+    rows = 0
+    for day, part in build_cube_days(jobs, workers):
+        filename = cube.write_part(output_filename, day, part)
+        for file, _, _ in files[day]:
+            manifest[file]["cube"] = filename
+            rows += manifest[file]["rows"]
+    return rows
+
+
+def backfill_index(index, manifest, output_filename):
+    # Индекс дублей, собранный до таблицы наблюдений: наблюдения восстанавливаются по url записанных частей
+    import pyarrow.parquet as pq
+
+    dataset_dir = storage.merged_dataset_dir(output_filename)
+    index.clear()
+    for file, entry in manifest.items():
+        part = os.path.join(dataset_dir, entry["part"])
+        if os.path.exists(part):
+            urls = pq.read_table(part, columns=['url']).column('url').to_pylist()
+            index.add(urls, file, seen_time(file, entry["mtime"]))
+    index.commit()
+
+
+def merge_excel_files(output_filename="merged_data", export_excel=False, rebuild=False, workers=1):
+    from tqdm import tqdm
+    import cube
+    from dedup_index import DedupIndex, index_path
+
     start_time = time.time()  # Засекаем время начала
 
-    # Получаем путь к папке raw (на один уровень выше от scripts)
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    project_root = os.path.dirname(os.path.dirname(script_dir))
-    raw_dir = os.path.join(project_root, "raw")
-    final_dir = os.path.join(raw_dir, "final")
-
-    # Создаем папку final, если ее нет
-    os.makedirs(final_dir, exist_ok=True)
-
-    all_dataframes = []
-    excel_files = [f for f in os.listdir(raw_dir) if f.endswith(".xlsx") and f != output_filename]
-
-    print(f"🔍 Найдено {len(excel_files)} Excel-файлов в {raw_dir}")
-
-    for file in tqdm(excel_files, desc="Обработка файлов", unit="file"):
-        file_path = os.path.join(raw_dir, file)
-        try:
-            df = pd.read_excel(file_path)
-            df['source_file'] = file  # добавить имя файла
-            all_dataframes.append(df)
-        except Exception as e:
-            print(f"\n⚠️ Ошибка при чтении {file}: {e}")
-
-    if all_dataframes:
-        merged_df = pd.concat(all_dataframes, ignore_index=True)
-        output_path = os.path.join(final_dir, output_filename)
-        merged_df.to_excel(output_path, index=False)
-
-        # Вычисляем время выполнения
-        elapsed_time = time.time() - start_time
-        print(f"\n✅ Готово! Объединено {len(all_dataframes)} файлов.")
-        print(f"📁 Результат сохранен в: {output_path}")
-        print(f"⏱ Время выполнения: {elapsed_time:.2f} секунд")
+    dataset_dir = storage.merged_dataset_dir(output_filename)
+    manifest_file = manifest_path(output_filename)
+    index = DedupIndex(index_path(output_filename))
+    if rebuild:
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        price_history.clear(output_filename)
+        cube.clear(output_filename)
+        index.clear()
+        manifest = {}
     else:
-        print("\n❌ Не удалось прочитать ни один Excel-файл.")
+        manifest = load_manifest(manifest_file)
+        if index.needs_backfill():
+            backfill_index(index, manifest, output_filename)
+            print("🔁 Индекс дублей пересобран по наблюдениям из записанных частей")
+
+    # Сырые файлы берутся из хранилища: партиции parquet и старые .xlsx в raw/
+    with span("scan") as s:
+        raw_files = storage.list_raw_files()
+        new_files = find_new_files(raw_files, manifest)
+        s.add_rows(len(raw_files))
+    file_info = {file_path: (stat, sha256) for file_path, stat, sha256 in new_files}
+
+    print(f"🔍 Найдено {len(raw_files)} файлов в {storage.RAW_DIR}, новых: {len(new_files)}, процессов: {workers}")
+
+    # Каждый файл сразу пишется отдельной частью и освобождается
+    merged_count = 0
+    results = read_raw_files(list(file_info), workers=workers)
+    days = set()
+    for file_path, (file, table, error) in tqdm(results, total=len(file_info), desc="Обработка файлов", unit="file"):
+        if error is not None:
+            print(f"\n⚠️ Ошибка при чтении {file}: {error}")
+            continue
+        stat, sha256 = file_info[file_path]
+        # Имя части зависит и от имени, и от содержимого: одинаковые копии не затирают друг друга
+        part_id = hashlib.sha256(f"{file}:{sha256}".encode('utf-8')).hexdigest()[:16]
+        with span("write_part") as s:
+            part_path = storage.write_merged_part(table, output_filename, part_id)
+            s.add_rows(table.num_rows)
+
+        old_entry = manifest.get(file)
+        if old_entry and old_entry["part"] != os.path.basename(part_path):
+            # Файл изменился - старая часть больше не нужна
+            old_part = os.path.join(dataset_dir, old_entry["part"])
+            if os.path.exists(old_part):
+                os.remove(old_part)
+            if old_entry.get("history"):
+                price_history.remove_part(output_filename, old_entry["history"])
+            if (old_entry.get("cube") or "").startswith("part-"):
+                cube.remove_part(output_filename, old_entry["cube"])
+            # День старой версии файла пересобирается без нее
+            days.add(seen_time(file, old_entry["mtime"])[:10])
+        # Индекс дублей: последнее наблюдение и история по url
+        seen_at = seen_time(file, stat.st_mtime)
+        with span("dedup_index") as s:
+            listings = index.add(table.column('url').to_pylist(), file, seen_at)
+            index.commit()
+            s.add_rows(table.num_rows)
+        # История цен дописывается только наблюдениями этого файла
+        with span("price_history") as s:
+            history_part = price_history.append_observations(table, output_filename, part_id, seen_at)
+            s.add_rows(table.num_rows)
+        # Куб пересобирается по дням после всех файлов: день может прийти в нескольких файлах
+        days.add(seen_at[:10])
+
+        manifest[file] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": sha256,
+            "rows": table.num_rows,
+            "listings": listings,
+            "part": os.path.basename(part_path),
+            "history": history_part,
+            "cube": None,
+        }
+        save_manifest(manifest_file, manifest)
+        merged_count += 1
+        del table
+
+    added, backfill_days = backfill_parts(manifest, output_filename)
+    if added or backfill_days - days:
+        print("📈 История цен и куб дополнены файлами из прошлых объединений")
+    with span("cube", days=len(days | backfill_days)) as s:
+        s.add_rows(update_cube(manifest, output_filename, days | backfill_days, workers=workers))
+    save_manifest(manifest_file, manifest)
+    unique_listings = index.count()
+    index.close()
+    if not manifest:
+        print("\n❌ Не удалось прочитать ни один файл.")
+        return
+
+    if export_excel:
+        with span("export_excel"):
+            print(f"📄 Выгрузка в Excel: {storage.export_merged_excel(output_filename)}")
+
+    # Вычисляем время выполнения
+    elapsed_time = time.time() - start_time
+    total_rows = sum(entry["rows"] for entry in manifest.values())
+    print(f"\n✅ Готово! Добавлено {merged_count} файлов, всего в наборе {len(manifest)} файлов, {total_rows} строк, "
+          f"уникальных объявлений: {unique_listings}.")
+    print(f"📁 Результат сохранен в: {dataset_dir}")
+    print(f"⏱ Время выполнения: {elapsed_time:.2f} секунд")
+
+
+def parse_args(argv=None):
+    return command_parser('merge').parse_args(argv)
+
+
+def main(args=None):
+    args = args if args is not None else parse_args()
+    with session('merge', args):
+        merge_excel_files(args.output, export_excel=args.excel, rebuild=args.rebuild, workers=args.workers)
 
 
 if __name__ == "__main__":
-    merge_excel_files()
\ No newline at end of file
+    main()
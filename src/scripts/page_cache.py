@@ -0,0 +1,231 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+import os
+import storage
+from instrument import session
+from parser_city import command_parser
+
+# Локальный кэш страниц cian.ru: тела хранятся по sha256 содержимого (одинаковые страницы - одна запись),
+# url -> хэш тела, время загрузки и последнего обращения. Свежие страницы (моложе TTL) отдаются без сети
+# и без ожидания ограничителя запросов, при превышении размера удаляются давно не читавшиеся страницы
+CACHE_DIR = os.path.join(storage.RAW_DIR, 'cache')
+DEFAULT_TTL_HOURS = 6.0
+DEFAULT_MAX_MB = 512
+# cianparser считает страницу выдачи неудачной и запрашивает заново, если на ней капча или нет шапки списка
+# (у новостроек - карточек ЖК). Такие страницы не кэшируются: иначе повтор получал бы ту же страницу до конца TTL
+LIST_PAGE_MARKER = '/cat.php'
+LIST_MARKERS = (b'HeaderDefault', b'GKCard')
+CAPTCHA_MARKER = b'Captcha'
+
+
+def cache_path():
+    return os.path.join(CACHE_DIR, "pages.sqlite")
+
+
+def cacheable(url, body):
+    if CAPTCHA_MARKER in body:
+        return False
+    if LIST_PAGE_MARKER in url:
+        return any(marker in body for marker in LIST_MARKERS)
+    return True
+
+
+class PageCacheMiss(Exception):
+    # Офлайн-режим: страницы нет в кэше, а в сеть ходить нельзя
+    pass
+
+
+class CachedResponse:
+    # Минимум того, что cianparser берет у ответа requests
+    status_code = 200
+
+    def __init__(self, url, body):
+        self.url = url
+        self.content = body
+        self.text = body.decode('utf-8')
+
+    def raise_for_status(self):
+        pass
+
+
+class PageCache:
+    def __init__(self, path, ttl_hours=DEFAULT_TTL_HOURS, max_mb=DEFAULT_MAX_MB, offline=False):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        # Сегменты пакетного режима идут в потоках - одно соединение под блокировкой
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS bodies ("
+            " sha256 TEXT PRIMARY KEY,"
+            " body BLOB,"
+            " size INTEGER)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " url TEXT PRIMARY KEY,"
+            " sha256 TEXT,"
+            " fetched_at REAL,"
+            " accessed_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_body ON pages (sha256)")
+
+    def get(self, url, accept=None):
+        # Тело страницы или None; в офлайн-режиме срок хранения не проверяется.
+        # accept(url, body) - False: страница негодная (записана до проверки), удаляется и считается промахом
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT b.body, p.fetched_at, p.sha256 FROM pages p JOIN bodies b ON b.sha256 = p.sha256"
+                " WHERE p.url = ?",
+                (url,)
+            ).fetchone()
+            if row is None or (not self.offline and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            body = zlib.decompress(row[0])
+            if accept is not None and not accept(url, body):
+                self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+                self._drop_body(row[2])
+                self.conn.commit()
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (now, url))
+            self.conn.commit()
+            self.hits += 1
+        return body
+
+    def put(self, url, body):
+        sha256 = hashlib.sha256(body).hexdigest()
+        compressed = zlib.compress(body, 6)
+        now = time.time()
+        with self._lock:
+            old = self.conn.execute("SELECT sha256 FROM pages WHERE url = ?", (url,)).fetchone()
+            self.conn.execute("INSERT OR IGNORE INTO bodies (sha256, body, size) VALUES (?, ?, ?)",
+                              (sha256, compressed, len(compressed)))
+            self.conn.execute(
+                "INSERT INTO pages (url, sha256, fetched_at, accessed_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(url) DO UPDATE SET sha256 = excluded.sha256,"
+                "  fetched_at = excluded.fetched_at, accessed_at = excluded.accessed_at",
+                (url, sha256, now, now)
+            )
+            if old is not None and old[0] != sha256:
+                self._drop_body(old[0])
+            self._evict()
+            self.conn.commit()
+
+    def _drop_body(self, sha256):
+        # Тело удаляется, когда на него не ссылается ни одна страница; возвращает освобожденный объем
+        if self.conn.execute("SELECT 1 FROM pages WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone() is not None:
+            return 0
+        row = self.conn.execute("SELECT size FROM bodies WHERE sha256 = ?", (sha256,)).fetchone()
+        self.conn.execute("DELETE FROM bodies WHERE sha256 = ?", (sha256,))
+        return row[0] if row is not None else 0
+
+    def _evict(self):
+        # LRU: пока тела больше лимита, удаляем страницы с самым старым обращением
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, sha256 in self.conn.execute("SELECT url, sha256 FROM pages ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            total -= self._drop_body(sha256)
+
+    def purge_expired(self):
+        with self._lock:
+            removed = self.conn.execute("DELETE FROM pages WHERE fetched_at < ?", (time.time() - self.ttl,)).rowcount
+            self.conn.execute("DELETE FROM bodies WHERE sha256 NOT IN (SELECT sha256 FROM pages)")
+            self.conn.commit()
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM pages")
+            self.conn.execute("DELETE FROM bodies")
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+
+    def stats(self):
+        with self._lock:
+            pages, fresh = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(fetched_at >= ?), 0) FROM pages", (time.time() - self.ttl,)
+            ).fetchone()
+            bodies, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM bodies").fetchone()
+        return {"pages": pages, "fresh": fresh, "bodies": bodies, "size_mb": round(size / 1024 / 1024, 2)}
+
+    def session(self, session, limiter=None):
+        return CachedSession(session, self, limiter)
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class CachedSession:
+    # Обертка сессии cloudscraper внутри CianParser: GET сначала ищется в кэше,
+    # в сеть (с ожиданием ограничителя) идут только промахи; остальные атрибуты - у исходной сессии
+    def __init__(self, session, cache, limiter=None):
+        object.__setattr__(self, "_session", session)
+        object.__setattr__(self, "_cache", cache)
+        object.__setattr__(self, "_limiter", limiter)
+
+    def get(self, url, **kwargs):
+        body = self._cache.get(url, accept=cacheable)
+        if body is not None:
+            return CachedResponse(url, body)
+        if self._cache.offline:
+            raise PageCacheMiss(f"Нет в кэше (офлайн-режим): {url}")
+        if self._limiter is not None:
+            self._limiter.wait()
+        response = self._session.get(url, **kwargs)
+        if response.status_code == 200 and cacheable(url, response.content):
+            self._cache.put(url, response.content)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def __setattr__(self, name, value):
+        # cianparser подменяет proxies у своей сессии
+        setattr(self._session, name, value)
+
+
+def open_cache(ttl_hours=DEFAULT_TTL_HOURS, max_mb=DEFAULT_MAX_MB, offline=False):
+    return PageCache(cache_path(), ttl_hours=ttl_hours, max_mb=max_mb, offline=offline)
+
+
+def parse_args(argv=None):
+    return command_parser('cache').parse_args(argv)
+
+
+def main(args=None):
+    args = args if args is not None else parse_args()
+    with session('cache', args):
+        cache = open_cache(ttl_hours=args.cache_ttl)
+        if args.clear:
+            cache.clear()
+            print(f"🧹 Кэш страниц очищен: {cache.path}")
+        elif args.purge_expired:
+            print(f"🧹 Удалено устаревших страниц: {cache.purge_expired()}")
+        stats = cache.stats()
+        cache.close()
+    print(f"📦 Кэш страниц {cache.path}: страниц {stats['pages']} (свежих {stats['fresh']}), "
+          f"тел {stats['bodies']}, {stats['size_mb']} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import importlib
+
+# Единая точка входа: python parser_city.py crawl|merge|test|plot|index|cube|bench|cache [параметры].
+# Здесь только argparse: модуль команды (и pandas, matplotlib, cianparser) импортируется
+# после разбора аргументов, поэтому --help и ошибки в параметрах отвечают сразу
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"ожидается целое число больше 0: {value}")
+    return number
+
+
+def task_list(value):
+    # "1,5" -> [1, 5]
+    try:
+        tasks = sorted({int(part) for part in value.split(',') if part.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"номера заданий через запятую, например 1,5: {value}")
+    if not tasks:
+        raise argparse.ArgumentTypeError("не указано ни одного задания")
+    return tasks
+
+
+def tolerance(value):
+    # price=1000 -> ("price", 1000.0)
+    field, sep, amount = value.partition("=")
+    try:
+        if sep and field.strip():
+            return field.strip(), float(amount)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"ожидается FIELD=VALUE, например price=1000: {value}")
+
+
+BENCH_STAGES = ('crawl', 'merge', 'compare', 'filters', 'aggregates', 'plots')
+
+
+def row_counts(value):
+    # "1e3,1e5,1000000" -> [1000, 100000, 1000000]
+    try:
+        sizes = [int(float(part)) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"число строк через запятую, например 1e3,1e5: {value}")
+    if not sizes or min(sizes) < 1:
+        raise argparse.ArgumentTypeError(f"число строк должно быть больше 0: {value}")
+    return sizes
+
+
+def stage_list(value):
+    stages = [part.strip() for part in value.split(',') if part.strip()]
+    unknown = [stage for stage in stages if stage not in BENCH_STAGES]
+    if not stages or unknown:
+        raise argparse.ArgumentTypeError(f"этапы через запятую из {', '.join(BENCH_STAGES)}: {value}")
+    return stages
+
+
+CUBE_DIMENSIONS = ('city', 'crawl_date', 'district', 'street', 'underground', 'floor', 'rooms_cat', 'type_property')
+
+
+def dimension_list(value):
+    # "district,rooms_cat" -> ['district', 'rooms_cat']
+    dimensions = [part.strip() for part in value.split(',') if part.strip()]
+    unknown = [dimension for dimension in dimensions if dimension not in CUBE_DIMENSIONS]
+    if not dimensions or unknown:
+        raise argparse.ArgumentTypeError(f"измерения через запятую из {', '.join(CUBE_DIMENSIONS)}: {value}")
+    return dimensions
+
+
+def dimension_value(value):
+    # district=Центральный -> ("district", "Центральный"); этаж - число
+    dimension, sep, member = value.partition("=")
+    dimension = dimension.strip()
+    if not sep or dimension not in CUBE_DIMENSIONS:
+        raise argparse.ArgumentTypeError(f"ожидается ИЗМЕРЕНИЕ=ЗНАЧЕНИЕ, измерения: {', '.join(CUBE_DIMENSIONS)}: {value}")
+    if dimension == 'floor':
+        try:
+            return dimension, int(member)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"этаж - целое число: {value}")
+    return dimension, member.strip()
+
+
+def quantile_value(value):
+    q = float(value)
+    if not 0 <= q <= 1:
+        raise argparse.ArgumentTypeError(f"квантиль от 0 до 1: {value}")
+    return q
+
+
+def add_common_arguments(parser):
+    parser.add_argument("--trace", action="store_true",
+                        help="записать этапы запуска в logs/trace_<команда>_<время>.jsonl и вывести сводку")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"], help="профиль запуска в logs/profile_*")
+
+
+def add_crawl_arguments(parser):
+    parser.add_argument("--batch", metavar="SEGMENTS_JSON",
+                        help="неинтерактивный режим: JSON-файл со списком сегментов")
+    parser.add_argument("--workers", type=positive_int, default=3, help="число параллельных сегментов")
+    parser.add_argument("--min-interval", type=float, default=2.0,
+                        help="минимальный интервал между запросами к cian.ru, сек")
+    parser.add_argument("--full", action="store_true",
+                        help="не останавливаться на уже сохраненных объявлениях")
+    parser.add_argument("--no-shard", action="store_true",
+                        help="не делить сегмент по площади и цене под лимит 75 страниц выдачи")
+    parser.add_argument("--excel", action="store_true", help="дополнительно выгрузить результат в .xlsx")
+    add_page_cache_arguments(parser)
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш страниц")
+    parser.add_argument("--cache-size", type=float, default=512, metavar="MB",
+                        help="предельный размер кэша страниц, старые по обращению удаляются")
+    parser.add_argument("--offline", action="store_true",
+                        help="только страницы из кэша, без запросов к cian.ru")
+
+
+def add_page_cache_arguments(parser):
+    parser.add_argument("--cache-ttl", type=float, default=6.0, metavar="HOURS",
+                        help="срок, в течение которого страница из кэша считается свежей, часов")
+
+
+def add_cache_arguments(parser):
+    add_page_cache_arguments(parser)
+    parser.add_argument("--clear", action="store_true", help="удалить все страницы из кэша")
+    parser.add_argument("--purge-expired", action="store_true", help="удалить страницы старше --cache-ttl")
+
+
+def add_merge_arguments(parser):
+    parser.add_argument("--output", default="merged_data", help="имя итогового набора в raw/final")
+    parser.add_argument("--excel", action="store_true", help="дополнительно выгрузить результат в .xlsx")
+    parser.add_argument("--rebuild", action="store_true", help="пересобрать набор заново, игнорируя манифест")
+    parser.add_argument("--workers", type=positive_int, default=1, help="число процессов для чтения файлов")
+
+
+def add_test_arguments(parser):
+    parser.add_argument("--batch", action="store_true",
+                        help="без диалога: сравнить все эталоны из atest с подходящими файлами из raw")
+    parser.add_argument("--workers", type=positive_int, default=None, help="число процессов для сравнений")
+    parser.add_argument("--tolerance", type=tolerance, action="append", metavar="FIELD=VALUE",
+                        help="допустимое расхождение по полю, например price=1000")
+
+
+def add_plot_arguments(parser):
+    parser.add_argument("--tasks", type=task_list, default=None, help="номера заданий через запятую, например 1,5")
+    parser.add_argument("--workers", type=positive_int, default=None, help="число процессов для рисования графиков")
+    parser.add_argument("--force", action="store_true", help="перерисовать графики, даже если данные не изменились")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="не использовать снимок подготовленных данных raw/snapshots, читать набор заново")
+
+
+def add_index_arguments(parser):
+    parser.add_argument("--output", default="merged_data", help="имя объединенного набора в raw/final")
+    parser.add_argument("--by", choices=["district", "rooms_cat"], default="district",
+                        help="группировка: район или тип по комнатам")
+    parser.add_argument("--freq", choices=["D", "W", "M", "Q"], default="M", help="период индекса")
+    parser.add_argument("--start", metavar="YYYY-MM-DD", help="первая дата запуска парсера")
+    parser.add_argument("--end", metavar="YYYY-MM-DD", help="последняя дата запуска парсера")
+
+
+def add_cube_arguments(parser):
+    parser.add_argument("--output", default="merged_data", help="имя объединенного набора в raw/final")
+    parser.add_argument("--by", type=dimension_list, default=None,
+                        help=f"свертка по измерениям через запятую: {','.join(CUBE_DIMENSIONS)} (по умолчанию итог)")
+    parser.add_argument("--where", type=dimension_value, action="append", metavar="DIMENSION=VALUE",
+                        help="срез по значению измерения, можно несколько раз (значения одного измерения - ИЛИ)")
+    parser.add_argument("--start", metavar="YYYY-MM-DD", help="первая дата запуска парсера")
+    parser.add_argument("--end", metavar="YYYY-MM-DD", help="последняя дата запуска парсера")
+    parser.add_argument("--measure", choices=["price", "price_per_m2", "total_meters"], default="price_per_m2",
+                        help="величина для квантилей и среднего без выбросов")
+    parser.add_argument("--quantile", type=quantile_value, action="append", default=None, metavar="Q",
+                        help="квантили величины по скетчам, можно несколько раз (по умолчанию медиана)")
+    parser.add_argument("--trimmed", action="store_true",
+                        help="среднее величины без выбросов за 5%% и 95%% квантилями групп")
+
+
+def add_bench_arguments(parser):
+    parser.add_argument("--stages", type=stage_list, default=None,
+                        help=f"этапы через запятую: {','.join(BENCH_STAGES)} (по умолчанию все)")
+    parser.add_argument("--sizes", type=row_counts, default=None,
+                        help="число строк через запятую, по умолчанию 1e3,1e4,1e5,1e6,1e7")
+    parser.add_argument("--repeat", type=positive_int, default=3, help="повторов каждого замера")
+    parser.add_argument("--output", help="JSON с результатами, по умолчанию logs/bench/bench_<время>.json")
+    parser.add_argument("--baseline", help="JSON прошлого запуска для поиска регрессий")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="регрессия, если этап медленнее базового во столько раз")
+
+
+# Команда -> (модуль, описание, параметры)
+COMMANDS = {
+    'crawl': ('parsihka', "Парсер объявлений cian.ru", add_crawl_arguments),
+    'merge': ('merge', "Объединение сырых файлов парсера", add_merge_arguments),
+    'test': ('autotest.auto_test', "Автотест: сравнение файлов парсера с эталонами", add_test_arguments),
+    'plot': ('plots', "Графики по объединенным данным", add_plot_arguments),
+    'index': ('price_history', "Индекс медианной цены за м² по запускам парсера", add_index_arguments),
+    'cube': ('cube', "Куб объявлений: свертки и срезы по измерениям", add_cube_arguments),
+    'bench': ('bench.benchmark', "Бенчмарк этапов на синтетических данных", add_bench_arguments),
+    'cache': ('page_cache', "Кэш страниц cian.ru: размер, очистка", add_cache_arguments),
+}
+
+
+def command_parser(command):
+    # Парсер одной команды - для запуска скрипта напрямую (python merge.py --rebuild)
+    _, description, add_arguments = COMMANDS[command]
+    parser = argparse.ArgumentParser(description=description)
+    add_arguments(parser)
+    add_common_arguments(parser)
+    return parser
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="parser_city", description="Parser City: сбор, объединение, проверка и графики")
+    subparsers = parser.add_subparsers(dest="command", metavar="{" + ",".join(COMMANDS) + "}", required=True)
+    for command, (_, description, add_arguments) in COMMANDS.items():
+        subparser = subparsers.add_parser(command, help=description, description=description)
+        add_arguments(subparser)
+        add_common_arguments(subparser)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    module = importlib.import_module(COMMANDS[args.command][0])
+    module.main(args)
+
+
+if __name__ == "__main__":
+    main()
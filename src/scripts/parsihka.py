@@ -1,9 +1,26 @@
-from cianparser import CianParser
-import pandas as pd
-from tqdm import tqdm
+from checkpoint import CrawlJournal, journal_path, parts_path, stored_urls
+from stream_writer import StreamingWriter
+import storage
+from instrument import session, span
+from page_cache import open_cache
+from sharding import offers_count, plan_shards
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from parser_city import command_parser
+import threading
+import json
 import time
 import os
 
+# Все запросы cianparser идут на один хост, поэтому лимит общий для всех сегментов
+CIAN_HOST = "cian.ru"
+PAGES_PER_SEGMENT = 75
+# Очередь страниц между сбором и записью; полная очередь приостанавливает сбор
+QUEUE_PAGES = 16
+# Сбор сегмента повторяется с паузой BACKOFF_SEC, 2 * BACKOFF_SEC, ... с первой несохраненной страницы
+SEGMENT_ATTEMPTS = 3
+BACKOFF_SEC = 5.0
+
 
 def select_from_list(prompt, options):
     print(prompt)
@@ -21,25 +38,41 @@ def select_from_list(prompt, options):
 
 
 def ensure_raw_directory_exists():
-    # Поднимаемся на три уровня вверх от src/scripts/ до BIGdata/
-    project_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-    raw_dir = os.path.join(project_root, 'raw')
-    if not os.path.exists(raw_dir):
-        os.makedirs(raw_dir)
-    return raw_dir
+    # Каталог raw/ в корне проекта (BIGdata/raw) - тот же, что у storage
+    os.makedirs(storage.RAW_DIR, exist_ok=True)
+    return storage.RAW_DIR
 
 
-def generate_filename(city, deal_type, rooms, min_area, max_area):
+class HostRateLimiter:
+    # Не чаще одного запроса к хосту за min_interval секунд, общий для всех потоков
+    def __init__(self, min_interval=2.0):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, host=CIAN_HOST):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def city_abbr(city):
     # Сокращения для городов
-    city_abbr = {
+    return {
         "Москва": "Msk",
         "Санкт-Петербург": "SPb",
         "Нижний Новгород": "NNov"
     }.get(city, city)
 
-    # Тип недвижимости
-    deal_type_abbr = "first" if deal_type.lower() == "новостройка" else "second"
 
+def deal_type_abbr(deal_type):
+    return "first" if deal_type.lower() == "новостройка" else "second"
+
+
+def generate_filename(city, deal_type, rooms, min_area, max_area):
     # Форматирование комнат
     if isinstance(rooms[0], str) and rooms[0] == "studio":
         room_str = "studio"
@@ -49,17 +82,25 @@ def generate_filename(city, deal_type, rooms, min_area, max_area):
     # Площадь
     area_str = f"({min_area}_{max_area})"
 
-    return f"{city_abbr}_{deal_type_abbr}_{room_str}_{area_str}"
+    return f"{city_abbr(city)}_{deal_type_abbr(deal_type)}_{room_str}_{area_str}"
 
 
-def main():
-    start_time = time.time()
+def load_segments(path):
+    # Файл сегментов: JSON-список объектов с полями city, deal_type, rooms, min_area, max_area
+    with open(path, 'r', encoding='utf-8') as f:
+        segments = json.load(f)
+    for segment in segments:
+        segment.setdefault("min_area", 0)
+        segment.setdefault("max_area", 250)
+        segment["rooms"] = [r if r == "studio" else int(r) for r in segment["rooms"]]
+    return segments
+
 
+def ask_segment():
     available_cities = ["Москва", "Санкт-Петербург", "Нижний Новгород"]
     city = select_from_list("Выберите город:", available_cities)
 
     deal_type = select_from_list("Выберите тип недвижимости:", ["Новостройка", "Вторичка"])
-    object_type = "new" if deal_type.lower() == "новостройка" else "secondary"
 
     room_options = ["Студия", "1", "2", "3", "4", "5"]
     print("Выберите типы комнат (через запятую):")
@@ -80,47 +121,352 @@ def main():
         min_area = 0
         max_area = 250
 
-    print(f"\nСобираем данные: {deal_type}, комнаты: {selected_rooms}, город: {city}")
+    return {
+        "city": city,
+        "deal_type": deal_type,
+        "rooms": selected_rooms,
+        "min_area": min_area,
+        "max_area": max_area,
+    }
 
-    parser = CianParser(location=city)
 
-    try:
-        raw_dir = ensure_raw_directory_exists()
-        base_filename = generate_filename(city, deal_type, selected_rooms, min_area, max_area)
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
-        filename = f"{base_filename}_{timestamp}.xlsx"
-        filepath = os.path.join(raw_dir, filename)
+def default_parser_factory():
+    # cianparser подключается только перед первым запросом, а не при показе меню
+    from cianparser import CianParser
+    return CianParser
+
+
+def search_settings(segment):
+    # Фильтры выдачи сегмента; одинаковые у пробы числа объявлений и у сбора, поэтому совпадают и url страниц
+    settings = {
+        "min_total_meters": segment["min_area"],
+        "max_total_meters": segment["max_area"],
+        "object_type": "new" if segment["deal_type"].lower() == "новостройка" else "secondary",
+    }
+    for key in ("min_price", "max_price"):
+        if key in segment:
+            settings[key] = segment[key]
+    return settings
+
+
+def offers_counter(parser_factory=None, limiter=None, page_cache=None):
+    # Проба: первая страница выдачи части и число объявлений из нее. С кэшем страниц эта же страница
+    # потом достается сбору без запроса, так что лишние запросы - только у частей, которые пришлось делить
+    parsers = {}
+
+    def count(segment):
+        from cianparser.cianparser import __build_url_list__
+
+        try:
+            if segment["city"] not in parsers:
+                factory = parser_factory or default_parser_factory()
+                parsers[segment["city"]] = factory(location=segment["city"])
+            parser = parsers[segment["city"]]
+            http_session = parser.__session__
+            if page_cache is not None:
+                http_session = page_cache.session(http_session, limiter)
+            elif limiter is not None:
+                limiter.wait()
+            url = __build_url_list__(location_id=parser.__location_id__, deal_type="sale", accommodation_type="flat",
+                                     rooms=tuple(segment["rooms"]), additional_settings=search_settings(segment))
+            response = http_session.get(url=url.format(1))
+            response.raise_for_status()
+            return offers_count(response.text)
+        except Exception as e:
+            print(f"⚠️ Не удалось узнать число объявлений {segment_basename(segment)}: {e}")
+            return None
+
+    return count
+
+
+def plan_segments(segments, parser_factory=None, limiter=None, page_cache=None):
+    # Каждый сегмент делится на части, укладывающиеся в лимит страниц выдачи
+    count = offers_counter(parser_factory, limiter, page_cache)
+    planned = []
+    for segment in segments:
+        with span("plan", file=segment_basename(segment)) as s:
+            shards, probes = plan_shards(segment, count, max_pages=PAGES_PER_SEGMENT)
+            s.add_rows(probes)
+        offers = sum(shard["offers"] or 0 for shard in shards)
+        print(f"🧩 {segment_basename(segment)}: объявлений {offers}, частей {len(shards)}, "
+              f"страниц {sum(shard['pages'] for shard in shards)}, проб {probes}")
+        for shard in shards:
+            if shard.get("truncated"):
+                print(f"⚠️ {segment_basename(shard)}: {shard['offers']} объявлений не делятся дальше, "
+                      f"будут собраны первые {PAGES_PER_SEGMENT} страниц")
+        planned.extend(shards)
+    return planned
+
+
+def crawl_segment(segment, parser_factory=None, limiter=None, on_page=None, journal=None, known_urls=None,
+                  page_cache=None, on_rows=None):
+    # Строки каждой страницы сразу уходят в журнал и в on_rows(rows) и в памяти не копятся;
+    # возвращает число переданных строк
+    # Число страниц части известно из плана, без плана - до лимита выдачи
+    end_page = segment.get("pages", PAGES_PER_SEGMENT)
+
+    # При наличии журнала продолжаем со следующей после последней сохраненной страницы
+    start_page = journal.last_page + 1 if journal is not None else 1
+    if start_page > end_page:
+        return 0
+    state = {"page": start_page, "rows": 0}
+
+    def deliver(rows):
+        if journal is not None:
+            journal.append_page(state["page"], rows)
+        if on_rows is not None:
+            on_rows(rows)
+        state["rows"] += len(rows)
+
+    def after_page(x):
+        # Новые строки страницы - всё, что cianparser добавил в result после прошлого вызова;
+        # отданные строки из result убираются, чтобы память не росла с числом страниц
+        page_parser = getattr(parser, "__parser__", None)
+        rows = list(page_parser.result) if page_parser is not None else []
+        if page_parser is not None:
+            del page_parser.result[:]
+        deliver(rows)
+        if known_urls and rows and all(row.get("url") in known_urls for row in rows):
+            # Дошли до уже сохраненных объявлений - дальше страницы не запрашиваем
+            page_parser.end_page = state["page"]
+        state["page"] += 1
+
+        if on_page is not None:
+            on_page(x)
+        if limiter is not None:
+            limiter.wait()
+
+    parser_factory = parser_factory or default_parser_factory()
+    parser = parser_factory(location=segment["city"])
+    http_session = getattr(parser, "__session__", None)
+    if page_cache is not None and http_session is not None:
+        # Ограничитель ждет только перед запросами в сеть: страницы из кэша идут без пауз
+        parser.__session__ = page_cache.session(http_session, limiter)
+        limiter = None
+    if limiter is not None:
+        limiter.wait()
+    # Время этапа включает ожидание ограничителя запросов между страницами
+    with span("get_flats", start_page=start_page) as s:
+        data = parser.get_flats(
+            deal_type="sale",
+            rooms=tuple(segment["rooms"]),
+            with_saving_csv=False,
+            additional_settings={
+                "start_page": start_page,
+                "end_page": end_page,
+                "callback_after_iteration": after_page,
+                **search_settings(segment),
+            }
+        )
+        # Хвост, не прошедший через callback (например, страница оборвалась ошибкой)
+        if data:
+            deliver(list(data))
+        s.add_rows(state["rows"])
+    return state["rows"]
+
+
+def segment_basename(segment):
+    base_filename = generate_filename(segment["city"], segment["deal_type"], segment["rooms"],
+                                      segment["min_area"], segment["max_area"])
+    if "min_price" in segment or "max_price" in segment:
+        base_filename += f"_p({segment.get('min_price', 0)}_{segment.get('max_price', '')})"
+    return base_filename
 
+
+def fetch_segment(segment, journal, parser_factory=None, limiter=None, on_page=None, stop_on_known=True,
+                  page_cache=None, on_rows=None):
+    # Выполняется в потоке сбора - у каждого сегмента свой корневой этап
+    base_filename = segment_basename(segment)
+    with span("segment", file=base_filename) as s:
+        with span("known_urls"):
+            known_urls = stored_urls(base_filename) if stop_on_known else None
+        count = crawl_segment(segment, parser_factory=parser_factory, limiter=limiter, on_page=on_page,
+                              journal=journal, known_urls=known_urls, page_cache=page_cache, on_rows=on_rows)
+        s.add_rows(count)
+    return count
+
+
+async def crawl_pipeline(segments, workers=3, limiter=None, parser_factory=None, on_page=None, stop_on_known=True,
+                         export_excel=False, page_cache=None, on_result=None):
+    # Производители - сегменты в потоках сбора (одновременно не больше workers, у каждого один запрос
+    # в работе), потребитель - одна задача записи. Страницы идут через ограниченную очередь: когда запись
+    # не успевает, сбор ждет, поэтому память не растет с длиной сбора
+    from tqdm import tqdm
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_PAGES)
+    slots = asyncio.Semaphore(workers)
+    failed = {}
+    raw_dir = ensure_raw_directory_exists()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crawl") as crawl_executor, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="write") as write_executor:
+
+        async def consume():
+            while True:
+                writer, item = await queue.get()
+                if writer is None:
+                    return
+                if isinstance(item, asyncio.Future):
+                    # Маркер конца сегмента: все его страницы уже записаны
+                    item.set_result(None)
+                elif writer not in failed:
+                    try:
+                        await loop.run_in_executor(write_executor, writer.write, item)
+                    except Exception as e:
+                        failed[writer] = e
+
+        async def produce(segment):
+            name = segment_basename(segment)
+            timestamp = time.strftime("%Y%m%d_%H%M%S")
+            async with slots:
+                try:
+                    journal = CrawlJournal(journal_path(raw_dir, name))
+                    writer = StreamingWriter(parts_path(raw_dir, name))
+                    if journal.last_page:
+                        tqdm.write(f"↩️ {name}: продолжаем после страницы {journal.last_page} "
+                                   f"({journal.row_count} объявлений из журнала)")
+                        for _, rows in journal.replay():
+                            await queue.put((writer, rows))
+
+                    def on_rows(rows):
+                        # Поток сбора ждет, пока в очереди освободится место
+                        asyncio.run_coroutine_threadsafe(queue.put((writer, rows)), loop).result()
+
+                    for attempt in range(SEGMENT_ATTEMPTS):
+                        try:
+                            await loop.run_in_executor(crawl_executor, fetch_segment, segment, journal, parser_factory,
+                                                       limiter, on_page, stop_on_known, page_cache, on_rows)
+                            break
+                        except Exception as e:
+                            if attempt + 1 == SEGMENT_ATTEMPTS:
+                                raise
+                            # Экспоненциальная пауза, затем продолжение с первой несохраненной страницы
+                            delay = BACKOFF_SEC * 2 ** attempt
+                            tqdm.write(f"🔁 {name}: {e}, повтор через {delay:.0f} сек "
+                                       f"со страницы {journal.last_page + 1}")
+                            await asyncio.sleep(delay)
+
+                    done = loop.create_future()
+                    await queue.put((writer, done))
+                    await done
+                    if writer in failed:
+                        raise failed[writer]
+                    path = storage.raw_path(name, city_abbr(segment["city"]), deal_type_abbr(segment["deal_type"]),
+                                            timestamp)
+                    filepath = await loop.run_in_executor(write_executor, writer.close, path)
+                    if export_excel and not filepath.endswith('.xlsx'):
+                        excel_path = os.path.join(storage.RAW_DIR, f"{name}_{timestamp}.xlsx")
+                        await loop.run_in_executor(write_executor, lambda: storage.write_table(
+                            storage.read_table(filepath), excel_path))
+                    # Файл записан - журнал больше не нужен
+                    journal.remove()
+                    result = {"segment": name, "file": filepath, "count": writer.rows}
+                except Exception as e:
+                    result = {"segment": name, "file": None, "count": 0, "error": str(e)}
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        consumer = asyncio.create_task(consume())
+        results = await asyncio.gather(*(produce(segment) for segment in segments))
+        await queue.put((None, None))
+        await consumer
+    return list(results)
+
+
+def run_batch(segments, workers=3, min_interval=2.0, parser_factory=None, stop_on_known=True,
+              export_excel=False, page_cache=None, shard=False):
+    from tqdm import tqdm
+
+    # Сегменты обрабатываются параллельно, но запросы к cian.ru идут не чаще min_interval
+    start_time = time.time()
+    limiter = HostRateLimiter(min_interval)
+    if shard:
+        segments = plan_segments(segments, parser_factory, limiter, page_cache)
+
+    print(f"Сегментов: {len(segments)}, потоков: {workers}, интервал запросов: {min_interval} сек")
+
+    def report(result):
+        if result["file"] is None:
+            tqdm.write(f"❌ {result['segment']}: ошибка при сборе данных: {result['error']}")
+        else:
+            tqdm.write(f"✅ {result['segment']}: {result['count']} объявлений -> {result['file']}")
+
+    total_pages = sum(segment.get("pages", PAGES_PER_SEGMENT) for segment in segments)
+    with tqdm(total=total_pages, desc="Парсинг страниц", unit="страница") as pbar:
+        results = asyncio.run(crawl_pipeline(segments, workers=workers, limiter=limiter,
+                                             parser_factory=parser_factory, on_page=lambda x: pbar.update(1),
+                                             stop_on_known=stop_on_known, export_excel=export_excel,
+                                             page_cache=page_cache, on_result=report))
+
+    execution_time = time.time() - start_time
+    mins, secs = divmod(execution_time, 60)
+    total = sum(r["count"] for r in results)
+    failed = sum(1 for r in results if r["file"] is None)
+    print(f"\n✅ Собрано {total} объявлений в {len(results) - failed} сегментах, ошибок: {failed}")
+    print(f"⏱ Время выполнения: {int(mins)} мин {int(secs)} сек")
+    return results
+
+
+def run_interactive(stop_on_known=True, export_excel=False, page_cache=None, shard=False):
+    start_time = time.time()
+
+    segment = ask_segment()
+    print(f"\nСобираем данные: {segment['deal_type']}, комнаты: {segment['rooms']}, город: {segment['city']}")
+
+    try:
         print("\nНачинаем парсинг...")
+        # tqdm и cianparser подключаются после выбора сегмента
+        from tqdm import tqdm
 
-        with tqdm(total=75, desc="Парсинг страниц", unit="страница") as pbar:
-            data = parser.get_flats(
-                deal_type="sale",
-                rooms=tuple(selected_rooms),
-                with_saving_csv=False,
-                additional_settings={
-                    "start_page": 1,
-                    "end_page": 75,
-                    "min_total_meters": min_area,
-                    "max_total_meters": max_area,
-                    "object_type": object_type,
-                    "callback_after_iteration": lambda x: pbar.update(1)
-                }
-            )
-
-        df = pd.DataFrame(data)
-        df.to_excel(filepath, index=False)
+        shards = plan_segments([segment], limiter=HostRateLimiter(), page_cache=page_cache) if shard else [segment]
+        total_pages = sum(s.get("pages", PAGES_PER_SEGMENT) for s in shards)
+        with tqdm(total=total_pages, desc="Парсинг страниц", unit="страница") as pbar:
+            results = asyncio.run(crawl_pipeline(shards, workers=1, on_page=lambda x: pbar.update(1),
+                                                 stop_on_known=stop_on_known, export_excel=export_excel,
+                                                 page_cache=page_cache))
+        errors = [r["error"] for r in results if r["file"] is None]
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        files = [r["file"] for r in results]
+        count = sum(r["count"] for r in results)
 
         execution_time = time.time() - start_time
         mins, secs = divmod(execution_time, 60)
 
-        print(f"\n✅ Успешно собрано {len(data)} объявлений.")
+        print(f"\n✅ Успешно собрано {count} объявлений.")
         print(f"⏱ Время выполнения: {int(mins)} мин {int(secs)} сек")
-        print(f"💾 Файл сохранен в: {filepath}")
+        for filepath in files:
+            print(f"💾 Файл сохранен в: {filepath}")
 
     except Exception as e:
         print(f"❌ Ошибка при сборе данных: {e}")
+        print("↩️ Собранные страницы сохранены в raw/journal, повторный запуск продолжит с места остановки")
+
+
+def parse_args(argv=None):
+    return command_parser('crawl').parse_args(argv)
+
+
+def main(args=None):
+    args = args if args is not None else parse_args()
+    if args.offline and args.no_cache:
+        print("❌ --offline работает только с кэшем страниц, уберите --no-cache")
+        return
+    page_cache = None if args.no_cache else open_cache(args.cache_ttl, args.cache_size, offline=args.offline)
+    with session('crawl', args):
+        if args.batch:
+            run_batch(load_segments(args.batch), workers=args.workers, min_interval=args.min_interval,
+                      stop_on_known=not args.full, export_excel=args.excel, page_cache=page_cache,
+                      shard=not args.no_shard)
+        else:
+            run_interactive(stop_on_known=not args.full, export_excel=args.excel, page_cache=page_cache,
+                            shard=not args.no_shard)
+    if page_cache is not None:
+        print(f"📦 Кэш страниц: из кэша {page_cache.hits}, промахов {page_cache.misses}")
+        page_cache.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
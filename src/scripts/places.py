@@ -0,0 +1,202 @@
+import math
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# Нормализация названий районов, улиц и метро и индекс объявлений по ним.
+# Поля cian.ru - свободный текст: пробелы по краям ("Ремесленная "), ё/е, сокращения ("пр-т", "наб."),
+# а в район иногда попадает заголовок объявления. Название сводится к ключу через кэш
+# (каждое уникальное значение разбирается один раз), варианты одного ключа становятся одной категорией
+PLACE_FIELDS = ('district', 'street', 'underground')
+# Сокращения типов улиц -> полное слово; "улица" cian.ru и так убирает, поэтому убираем и мы
+STREET_ABBREVIATIONS = {
+    'ул': '', 'улица': '',
+    'пр': 'проспект', 'пр-т': 'проспект', 'просп': 'проспект', 'пр-кт': 'проспект',
+    'пер': 'переулок', 'наб': 'набережная', 'ш': 'шоссе', 'б-р': 'бульвар', 'бул': 'бульвар',
+    'пл': 'площадь', 'пр-д': 'проезд', 'линия': 'линия', 'кан': 'канал',
+}
+STATION_PREFIX = re.compile(r'^(м\.|метро|ст\.\s*м\.)\s*', re.IGNORECASE)
+DISTRICT_SUFFIX = re.compile(r'\s+(район|р-н)$', re.IGNORECASE)
+# Заголовок объявления вместо района: цифры, "!", слова про квартиру
+LEAKED_TITLE = re.compile(r'[\d!]|кв-?р|квартир|ккв|студи|комн|двушк|трешк|однушк', re.IGNORECASE)
+TOKEN = re.compile(r'[\w-]+')
+# Сетка для поиска по координатам, градусы (~1 км по широте)
+GRID_STEP = 0.01
+EARTH_RADIUS_KM = 6371.0
+
+
+def clean_name(value):
+    # Общая чистка: ё -> е, неразрывные пробелы, повторные пробелы, кавычки и точки по краям
+    text = str(value).replace('ё', 'е').replace('Ё', 'Е').replace('\xa0', ' ')
+    text = re.sub(r'\s+', ' ', text).strip(' "\'«».,;')
+    return text
+
+
+@lru_cache(maxsize=None)
+def canonical_district(value):
+    # (ключ, название) или None, если это не район
+    text = DISTRICT_SUFFIX.sub('', clean_name(value))
+    if not text or LEAKED_TITLE.search(text):
+        return None
+    text = text[0].upper() + text[1:]
+    return text.casefold(), text
+
+
+@lru_cache(maxsize=None)
+def canonical_street(value):
+    words = []
+    for word in clean_name(value).split(' '):
+        full = STREET_ABBREVIATIONS.get(word.rstrip('.').casefold(), word)
+        if full:
+            words.append(full)
+    text = ' '.join(words)
+    if not text:
+        return None
+    # "проспект Энергетиков" и "Энергетиков проспект" - одна улица: ключ не зависит от порядка слов
+    return ' '.join(sorted(text.casefold().split(' '))), text
+
+
+@lru_cache(maxsize=None)
+def canonical_station(value):
+    text = STATION_PREFIX.sub('', clean_name(value))
+    if not text:
+        return None
+    text = text[0].upper() + text[1:]
+    return text.casefold(), text
+
+
+CANONICAL = {
+    'district': canonical_district,
+    'street': canonical_street,
+    'underground': canonical_station,
+}
+
+
+def normalize_column(column, canonical):
+    # Разбираются только категории, строки перекодируются одной выборкой по массиву кодов.
+    # Название варианта, встреченного первым, становится названием категории
+    cat = column.astype('category').cat
+    keys = {}
+    names = []
+    mapping = np.full(len(cat.categories) + 1, -1, dtype='int64')
+    for i, value in enumerate(cat.categories):
+        result = canonical(value)
+        if result is None:
+            continue
+        key, name = result
+        if key not in keys:
+            keys[key] = len(names)
+            names.append(name)
+        mapping[i] = keys[key]
+    # Код -1 (пусто) попадает в последний элемент mapping и остается пустым
+    codes = mapping[cat.codes.to_numpy()]
+    return pd.Categorical.from_codes(codes, categories=names)
+
+
+def normalize_places(df, fields=PLACE_FIELDS):
+    # Колонки районов, улиц и метро заменяются каноническими категориями (на месте)
+    for field in fields:
+        if field in df.columns:
+            df[field] = normalize_column(df[field], CANONICAL[field])
+    return df
+
+
+def name_key(field, value):
+    result = CANONICAL[field](value)
+    return result[0] if result is not None else None
+
+
+class GridIndex:
+    # Ячейки сетки GRID_STEP x GRID_STEP градусов -> номера строк; поиск в радиусе смотрит только соседние ячейки
+    def __init__(self, lat, lon, step=GRID_STEP):
+        self.step = step
+        self.lat = np.asarray(lat, dtype='float64')
+        self.lon = np.asarray(lon, dtype='float64')
+        valid = np.flatnonzero(~(np.isnan(self.lat) | np.isnan(self.lon)))
+        cells = zip(np.floor(self.lat[valid] / step).astype(int), np.floor(self.lon[valid] / step).astype(int))
+        self.cells = {}
+        for position, cell in zip(valid, cells):
+            self.cells.setdefault(cell, []).append(position)
+
+    def within(self, lat, lon, radius_km):
+        lat_cells = math.ceil(radius_km / 111.0 / self.step)
+        lon_cells = math.ceil(radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01)) / self.step)
+        row, col = math.floor(lat / self.step), math.floor(lon / self.step)
+        candidates = [position
+                      for i in range(row - lat_cells, row + lat_cells + 1)
+                      for j in range(col - lon_cells, col + lon_cells + 1)
+                      for position in self.cells.get((i, j), ())]
+        candidates = np.array(candidates, dtype='int64')
+        if not len(candidates):
+            return candidates
+        # Гаверсинус до кандидатов
+        lat1, lon1 = math.radians(lat), math.radians(lon)
+        lat2, lon2 = np.radians(self.lat[candidates]), np.radians(self.lon[candidates])
+        a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+        return np.sort(candidates[distance <= radius_km])
+
+
+class PlaceIndex:
+    # Инвертированный индекс по нормализованным названиям: ключ -> номера строк (позиции в df),
+    # слово названия -> ключи. Запросы "рядом с метро X", "в районе Y" не проходят по всем строкам
+    def __init__(self, df, fields=PLACE_FIELDS):
+        self.df = df
+        self.postings = {}
+        self.names = {}
+        self.tokens = {}
+        for field in fields:
+            if field not in df.columns:
+                continue
+            column = normalize_column(df[field], CANONICAL[field])
+            codes = np.asarray(column.codes)
+            # Одна сортировка кодов: строки каждой категории идут подряд
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(column.categories) + 1))
+            postings, names, tokens = {}, {}, {}
+            for code, name in enumerate(column.categories):
+                key = name_key(field, name)
+                postings[key] = order[bounds[code]:bounds[code + 1]]
+                names[key] = name
+                for token in TOKEN.findall(key):
+                    tokens.setdefault(token, set()).add(key)
+            self.postings[field], self.names[field], self.tokens[field] = postings, names, tokens
+        self.grid = GridIndex(df['lat'], df['lon']) if {'lat', 'lon'} <= set(df.columns) else None
+
+    def keys(self, field, text):
+        # Ключи названий, содержащих все слова text ("ленина" -> "Площадь Ленина")
+        words = TOKEN.findall(name_key(field, text) or '')
+        if not words or field not in self.tokens:
+            return set()
+        matches = [self.tokens[field].get(word, set()) for word in words]
+        return set.intersection(*matches)
+
+    def rows(self, field, text, exact=True):
+        # Позиции строк с названием text: точное совпадение ключа или (exact=False) по словам
+        postings = self.postings.get(field, {})
+        keys = [name_key(field, text)] if exact else sorted(self.keys(field, text))
+        parts = [postings[key] for key in keys if key in postings]
+        return np.sort(np.concatenate(parts)) if parts else np.array([], dtype='int64')
+
+    def near_station(self, station, exact=True):
+        return self.df.iloc[self.rows('underground', station, exact)]
+
+    def in_district(self, district, exact=True):
+        return self.df.iloc[self.rows('district', district, exact)]
+
+    def on_street(self, street, exact=True):
+        return self.df.iloc[self.rows('street', street, exact)]
+
+    def select(self, **where):
+        # Пересечение условий по нескольким полям: select(district='Приморский', underground='Старая Деревня')
+        positions = None
+        for field, text in where.items():
+            rows = self.rows(field, text)
+            positions = rows if positions is None else np.intersect1d(positions, rows, assume_unique=True)
+        return self.df.iloc[positions if positions is not None else np.arange(len(self.df))]
+
+    def within(self, lat, lon, radius_km):
+        if self.grid is None:
+            raise ValueError("В данных нет координат (колонки lat и lon)")
+        return self.df.iloc[self.grid.within(lat, lon, radius_km)]
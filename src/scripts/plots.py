@@ -1,76 +1,110 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
-import matplotlib.ticker as mtick
-import numpy as np
-import sys
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import inspect
+import pickle
+import json
+import storage
+import snapshot
+from instrument import session, span
+from parser_city import command_parser
 
 # Настройки путей
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # project/
-INPUT_FILENAME = os.path.join(BASE_DIR, 'raw', 'final', 'Данные_по_курсачу.xlsx')
+BASE_DIR = storage.BASE_DIR  # project/
+INPUT_NAME = 'Данные_по_курсачу'  # raw/final/<имя>.parquet или .xlsx
 FILTER_FILENAME = os.path.join(BASE_DIR, 'filters.txt')
 RESULTS_DIR = os.path.join(BASE_DIR, 'figures')
 README_FILENAME = os.path.join(RESULTS_DIR, 'readME.txt')
-os.makedirs(RESULTS_DIR, exist_ok=True)
+# Ключи уже нарисованных графиков и их описания для README
+RENDER_CACHE_FILENAME = os.path.join(RESULTS_DIR, '.render_cache.json')
+
+# Номер задания -> (подготовка входных данных, рисование графика)
+TASKS = {}
+
+
+def register_task(number, prepare):
+    # prepare(dataset) считается в главном процессе по готовым агрегатам,
+    # функция рисования получает только ее результат и выполняется в обработчике
+    def decorator(plot):
+        TASKS[number] = (prepare, plot)
+        return plot
+    return decorator
+
+
+class Dataset:
+    # Отфильтрованные строки, агрегаты и правила filters.txt - общие входные данные всех заданий
+    def __init__(self, df, aggs, filter_set):
+        self.df = df
+        self.aggs = aggs
+        self.filter_set = filter_set
 
-# Очистка файла readME.txt перед началом работы
-with open(README_FILENAME, 'w', encoding='utf-8') as f:
-    f.write("Результаты анализа данных по недвижимости\n")
-    f.write("=" * 50 + "\n\n")
 
 # Загрузка данных
-try:
-    df = pd.read_excel(INPUT_FILENAME)
+def load_data():
+    # Повторы объявления (из нескольких файлов или страниц выдачи) - одна строка с последним наблюдением
+    import places
+    from dedup_index import DEDUP_COLUMNS, load_deduplicated
+
+    df = load_deduplicated(INPUT_NAME).drop(columns=DEDUP_COLUMNS, errors='ignore')
     df = df.dropna(subset=['price', 'total_meters'])
     df['price_per_m2'] = df['price'] / df['total_meters']
-except Exception as e:
-    print(f"Ошибка при загрузке данных: {e}")
-    exit()
+    # Районы, улицы и метро - канонические названия: варианты написания сливаются, заголовки вместо района - пусто
+    with span("normalize_places"):
+        places.normalize_places(df)
+    return df
+
 
+# Применение фильтров: общие правила filters.txt отсекают строки до всех заданий
+def load_filter_set():
+    from filters_engine import FilterSet, load_filters
 
-# Применение фильтров
-def apply_filters(df):
     if not os.path.exists(FILTER_FILENAME):
-        return df
+        return FilterSet([], None)
     try:
-        with open(FILTER_FILENAME, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        filters = {}
-        current_task = None
-        for line in lines:
-            line = line.strip()
-            if line.startswith('#'):
-                current_task = line.strip('#').strip('.').strip()
-                filters[current_task] = []
-            elif line and current_task:
-                filters[current_task].append(line)
-        for task, values in filters.items():
-            for val in values:
-                if 'комн' in val:
-                    df = df[~((df['rooms_count'].astype(str) + ' комн. кв-ра').str.contains(val.split('!')[0].strip()))]
-                elif val in df['district'].values:
-                    df = df[df['district'] != val]
+        return load_filters(FILTER_FILENAME)
     except Exception as e:
         print(f"Ошибка при применении фильтров: {e}")
-    return df
+        return FilterSet([], None)
 
 
-df = apply_filters(df)
+def apply_filters(df, filter_set):
+    from filters_engine import format_hits
 
-# Сброс стилей
-sns.set(style='whitegrid', font_scale=1.1)
+    df, hits = filter_set.apply(df)
+    if hits:
+        print("Фильтры (все задания):")
+        print("\n".join(format_hits(hits)))
+    return df
 
 
-# Сохраняем график и добавляем описание в README
-def save_plot(fig, task_number, description):
-    try:
-        fig.savefig(os.path.join(RESULTS_DIR, f"task_{task_number}.png"), bbox_inches='tight')
-        plt.close(fig)
-        with open(README_FILENAME, 'a', encoding='utf-8') as f:
-            f.write(f"Задание {task_number}:\n{description}\n\n")
-    except Exception as e:
-        print(f"Ошибка при сохранении графика {task_number}: {e}")
+# Фильтры отдельных заданий (секции #N в filters.txt)
+def task_filter(dataset, task):
+    # Правила только по измерениям сетки агрегатов проверяются на ней, без прохода по строкам:
+    # отброшенные объявления считаются по price_count ячеек сетки
+    from aggregates import build_aggregates
+    from filters_engine import format_hits
+
+    filter_set, aggs = dataset.filter_set, dataset.aggs
+    rules = filter_set.section(task)
+    if not rules:
+        return aggs, None
+    print(f"Фильтры задания {task}:")
+    if filter_set.fields(task) <= set(aggs.grain.columns):
+        _, hits = filter_set.mask(aggs.grain, task, weights=aggs.grain['price_count'])
+        print("\n".join(format_hits(hits)))
+        return aggs, lambda grain: filter_set.mask(grain, task)[0]
+    keep, hits = filter_set.mask(dataset.df, task)
+    print("\n".join(format_hits(hits)))
+    return build_aggregates(dataset.df[keep]), None
+
+
+def known_district(where):
+    # Задания по районам: строки без района (и заголовки объявлений, которые places.py делает пустым
+    # районом) в средние и диапазоны цен не входят
+    def keep(grain):
+        known = grain['district'].notna()
+        return known if where is None else known & where(grain)
+    return keep
 
 
 # Функция для форматирования цен
@@ -84,49 +118,48 @@ def format_price(x, pos):
 
 
 # 1. Топ-5 самых дорогих квартир по районам и метро
-try:
-    top_districts = df.groupby('district')['price'].max().sort_values(ascending=False).head(5).index
-
-    top_flats_by_district = []
-    for district in top_districts:
-        district_data = df[df['district'] == district].sort_values('price', ascending=False)
-        unique_metro = set()
-        count = 0
-        for _, row in district_data.iterrows():
-            metro = row['underground']
-            if metro not in unique_metro:
-                unique_metro.add(metro)
-                top_flats_by_district.append({
-                    'district': district,
-                    'underground': metro,
-                    'price': row['price'],
-                    'address': row.get('address', 'N/A')
-                })
-                count += 1
-            if count == 2:
-                break
-
-    top_flats_df = pd.DataFrame(top_flats_by_district)
+def task_1_data(dataset):
+    from aggregates import top_k_distinct
+
+    top_districts = dataset.aggs.by('district')['price_max'].sort_values(ascending=False).head(5).index
+
+    # Две самые дорогие квартиры с разными станциями метро в каждом районе
+    top_flats_df = top_k_distinct(dataset.df, 'district', 'underground', 'price', k=2, groups=top_districts)
+    return {
+        'top_districts': list(top_districts),
+        # Категории -> строки: группировка и подписи графика не зависят от списка категорий
+        'top_flats': top_flats_df[['district', 'underground', 'price']].astype(
+            {'district': 'string', 'underground': 'string'}),
+    }
+
+
+@register_task(1, task_1_data)
+def task_1_plot(data):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+
+    top_districts, top_flats_df = data['top_districts'], data['top_flats'].copy()
+    district_index = {district: i for i, district in enumerate(top_districts)}
+    top_flats_df['position'] = (top_flats_df['district'].map(district_index) - 0.4
+                                + top_flats_df.groupby('district', sort=False).cumcount() * 0.2)
+    district_stats = top_flats_df.groupby('district', sort=False)['price'].agg(['max', 'count'])
 
     fig1, ax1 = plt.subplots(figsize=(16, 10))
     colors = plt.cm.tab10.colors
-    bar_positions = []
-    metro_labels = []
 
     for i, district in enumerate(top_districts):
-        district_data = top_flats_df[top_flats_df['district'] == district]
+        district_max, district_count = district_stats.loc[district, 'max'], district_stats.loc[district, 'count']
         x_min = i - 0.4
-        x_max = i + 0.4 + (len(district_data) - 1) * 0.2
-        rect = plt.Rectangle((x_min, 0), x_max - x_min, district_data['price'].max() * 1.05,
+        x_max = i + 0.4 + (district_count - 1) * 0.2
+        rect = plt.Rectangle((x_min, 0), x_max - x_min, district_max * 1.05,
                              alpha=0.1, color=colors[i], label=district)
         ax1.add_patch(rect)
 
-        ax1.text(x_min + (x_max - x_min) / 2, district_data['price'].max() * 1.08, district,
+        ax1.text(x_min + (x_max - x_min) / 2, district_max * 1.08, district,
                  ha='center', va='bottom', fontsize=12, fontweight='bold')
 
-        for j, (_, row) in enumerate(district_data.iterrows()):
-            bar_positions.append((i - 0.4 + j * 0.2, row['price']))
-            metro_labels.append(row['underground'])
+    bar_positions = list(zip(top_flats_df['position'], top_flats_df['price']))
+    metro_labels = top_flats_df['underground'].tolist()
 
     bars = ax1.bar([pos[0] for pos in bar_positions], [pos[1] for pos in bar_positions],
                    width=0.2, color='tab:blue', alpha=0.7)
@@ -145,33 +178,26 @@ try:
 
     # Формируем подробное описание для README
     district_info = []
-    for d in top_districts:
-        max_price = int(top_flats_df[top_flats_df['district'] == d]['price'].max() / 1_000_000)
-        metro_list = top_flats_df[top_flats_df['district'] == d]['underground'].unique()
-        metro_prices = [
-            f"{m}: {int(top_flats_df[(top_flats_df['district'] == d) & (top_flats_df['underground'] == m)]['price'].max() / 1_000_000)} млн"
-            for m in metro_list
-        ]
+    for d, rows in top_flats_df.groupby('district', sort=False):
+        max_price = int(rows['price'].max() / 1_000_000)
+        metro_prices = [f"{m}: {int(p / 1_000_000)} млн" for m, p in zip(rows['underground'], rows['price'])]
         district_info.append(f"- {d}: максимальная цена {max_price} млн руб. (метро: {', '.join(metro_prices)})")
 
     description = "Топ-5 районов по максимальной цене квартиры.\n\nИнформация по районам:\n" + "\n".join(district_info)
+    return fig1, description
 
-    save_plot(fig1, 1, description)
-except Exception as e:
-    print(f"Ошибка при создании графика 1: {e}")
 
 # 2. Цена за м² Новостройка/Вторичка с разницей (без 5% выбросов)
-try:
-    filtered_df = df.copy()
-    for prop_type in filtered_df['type_property'].unique():
-        subset = filtered_df[filtered_df['type_property'] == prop_type]
-        lower_bound = subset['price_per_m2'].quantile(0.05)
-        upper_bound = subset['price_per_m2'].quantile(0.95)
-        filtered_df = filtered_df[~((filtered_df['type_property'] == prop_type) &
-                                    ((filtered_df['price_per_m2'] < lower_bound) |
-                                     (filtered_df['price_per_m2'] > upper_bound)))]
-
-    mean_price = filtered_df.groupby('type_property')['price_per_m2'].mean()
+def task_2_data(dataset):
+    return {'mean_price': dataset.aggs.trimmed['price_per_m2_by_type']}
+
+
+@register_task(2, task_2_data)
+def task_2_plot(data):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    mean_price = data['mean_price']
     diff = abs(mean_price.diff().iloc[-1])
 
     # Округление до 10 тысяч
@@ -197,14 +223,20 @@ try:
         f"- Вторичка: {int(mean_price_rounded.iloc[1] / 1000)} тыс. руб./м²\n"
         f"Разница: {int(diff_rounded / 1000)} тыс. руб./м²"
     )
+    return fig2, description
 
-    save_plot(fig2, 2, description)
-except Exception as e:
-    print(f"Ошибка при создании графика 2: {e}")
 
 # 3. Топ-5 улиц по средней цене квартиры
-try:
-    street_avg = df.groupby('street')['price'].mean()
+def task_3_data(dataset):
+    return {'street_avg': dataset.aggs.mean('street')}
+
+
+@register_task(3, task_3_data)
+def task_3_plot(data):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+
+    street_avg = data['street_avg']
     top5_streets = street_avg.sort_values(ascending=False).head(5)
     bottom5_streets = street_avg.sort_values().head(5)
 
@@ -242,15 +274,20 @@ try:
                                                                     "Топ-5 дешёвых улиц:\n" + "\n".join(
         bottom_streets_info)
     )
+    return fig4, description
 
-    save_plot(fig4, 3, description)
-except Exception as e:
-    print(f"Ошибка при создании графика 3: {e}")
 
 # 4. Этажи в многоквартирных домах (по средней цене квартиры)
-try:
-    multi_floors = df[df['floors_count'] > 1]
-    mean_by_floor = multi_floors.groupby('floor')['price'].mean()
+def task_4_data(dataset):
+    return {'mean_by_floor': dataset.aggs.mean('floor', where=lambda g: g['multi_floor'].astype(bool))}
+
+
+@register_task(4, task_4_data)
+def task_4_plot(data):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+
+    mean_by_floor = data['mean_by_floor']
 
     top5_cheapest_floors = mean_by_floor.sort_values().head(5)
     top5_expensive_floors = mean_by_floor.sort_values(ascending=False).head(5)
@@ -286,38 +323,41 @@ try:
                                                                           "Самые дешёвые этажи:\n" + "\n".join(
         cheap_floors_info)
     )
+    return fig6, description
 
-    save_plot(fig6, 4, description)
-except Exception as e:
-    print(f"Ошибка при создании графика 4: {e}")
-
-# Список районов, которые нужно убрать
-districts_to_remove = [
-    "1 комн. кв-ра в развитом е!1-комн. квартира",
-    "1 комн. кв-ра в зеленом е!1-комн. квартира",
-    "1к-квартира в Московском е1-комн. квартира",
-    "2 комн. кв-ра в развитом е!2-комн. квартира",
-    "Двушка у парка в Невском е2-комн. квартира",
-    "Евродвушка в Московском е1-комн. квартира",
-    "Квартира-студия в Приморском еСтудия",
-    "Просторная 1 ккв  Приморский 1-комн. квартира",
-    "Студия в развитом е!Студия",
-    "Студия в Московском е!Студия"
-]
-
-# Фильтруем данные для 5-го и 6-го графиков
-filtered_df_for_graphs = df[~df['district'].isin(districts_to_remove)]
 
 # 5. Дешёвые предложения по районам и типу (улучшенная версия)
-try:
-    fig7, ax7 = plt.subplots(figsize=(14, 8))
+def task_5_data(dataset):
+    aggs5, where5 = task_filter(dataset, 5)
+    where5 = known_district(where5)
 
-    # Строим график
-    sns.barplot(data=filtered_df_for_graphs, x='district', y='price', hue='type_property',
-                ax=ax7, estimator='mean', errorbar=None)
+    # Готовые средние (порядок районов и типов - как в исходных данных)
+    district_type_avg = aggs5.by(['district', 'type_property'], where=where5, sort=False)['price_mean'].reset_index()
+    district_type_avg['district'] = district_type_avg['district'].astype(str)
+    district_type_avg['type_property'] = district_type_avg['type_property'].astype(str)
 
     # Находим глобальные мин и макс цены для каждого типа
-    global_min_max = filtered_df_for_graphs.groupby('type_property')['price'].agg(['min', 'max']).reset_index()
+    global_min_max = aggs5.by('type_property', where=where5)[['price_min', 'price_max']] \
+        .rename(columns={'price_min': 'min', 'price_max': 'max'}).reset_index()
+    return {
+        'district_type_avg': district_type_avg,
+        'global_min_max': global_min_max,
+        'district_avg': aggs5.mean('district', where=where5),
+    }
+
+
+@register_task(5, task_5_data)
+def task_5_plot(data):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+    import seaborn as sns
+
+    district_type_avg, global_min_max = data['district_type_avg'], data['global_min_max']
+    fig7, ax7 = plt.subplots(figsize=(14, 8))
+
+    sns.barplot(data=district_type_avg, x='district', y='price_mean', hue='type_property', ax=ax7,
+                order=district_type_avg['district'].unique(), hue_order=district_type_avg['type_property'].unique(),
+                errorbar=None)
 
     # Добавляем информацию о мин/макс в легенду с точными значениями
     handles, labels = ax7.get_legend_handles_labels()
@@ -348,7 +388,7 @@ try:
         max_val = int(row['max'] / 1_000_000)
         type_stats.append(f"- {row['type_property']}: от {min_val} млн до {max_val} млн руб.")
 
-    district_avg = filtered_df_for_graphs.groupby('district')['price'].mean().sort_values(ascending=False)
+    district_avg = data['district_avg'].sort_values(ascending=False)
     top_districts = [f"{district}: {int(price / 1_000_000)} млн руб."
                      for district, price in district_avg.head(5).items()]
 
@@ -358,15 +398,25 @@ try:
                                                                               "Топ-5 самых дорогих районов:\n" + "\n".join(
         top_districts)
     )
+    return fig7, description
 
-    save_plot(fig7, 5, description)
-except Exception as e:
-    print(f"Ошибка при создании графика 5: {e}")
 
 # 6. Средняя цена по районам и городу
-try:
-    city_avg = filtered_df_for_graphs['price'].mean()
-    district_avg = filtered_df_for_graphs.groupby('district')['price'].mean()
+def task_6_data(dataset):
+    aggs6, where6 = task_filter(dataset, 6)
+    where6 = known_district(where6)
+    return {
+        'city_avg': aggs6.total(where=where6)['price_mean'],
+        'district_avg': aggs6.mean('district', where=where6),
+    }
+
+
+@register_task(6, task_6_data)
+def task_6_plot(data):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+
+    city_avg, district_avg = data['city_avg'], data['district_avg']
     fig8, ax8 = plt.subplots()
     district_avg.plot(kind='bar', ax=ax8)
     ax8.axhline(city_avg, color='red', linestyle='--',
@@ -393,47 +443,37 @@ try:
                                                                        "Топ-5 районов ниже среднего:\n" + "\n".join(
         below_info)
     )
+    return fig8, description
 
-    save_plot(fig8, 6, description)
-except Exception as e:
-    print(f"Ошибка при создании графика 6: {e}")
 
 # 7. Средняя цена по количеству комнат (полностью исправленная версия)
-try:
-    # Преобразуем rooms_count в целые числа, заменяем NaN на 0
-    df['rooms_count'] = pd.to_numeric(df['rooms_count'], errors='coerce').fillna(0).astype(int)
-
-    # Создаем категории
-    conditions = [
-        (df['rooms_count'] == 0),
-        (df['rooms_count'] == 1),
-        (df['rooms_count'] == 2),
-        (df['rooms_count'] == 3),
-        (df['rooms_count'] >= 4)
-    ]
-    choices = ['0', '1', '2', '3', '4+']
-    df['rooms_cat'] = np.select(conditions, choices, default='4+')
+ROOM_ORDER = ['0', '1', '2', '3', '4+']
+ROOM_LABELS = ['Студия', '1-комн.', '2-комн.', '3-комн.', '4+ комн.']
+
+
+def task_7_data(dataset):
+    # Категории комнат (0 - студия, 4+) посчитаны в aggregates.
+    # Средняя цена по категориям, отсутствующие категории - 0
+    room_avg = dataset.aggs.mean('rooms_cat')
+    room_avg.index = room_avg.index.astype(str)
+    return {'room_avg': room_avg.reindex(ROOM_ORDER, fill_value=0)}
 
-    # Убедимся, что все категории существуют
-    room_order = ['0', '1', '2', '3', '4+']
-    room_labels = ['Студия', '1-комн.', '2-комн.', '3-комн.', '4+ комн.']
 
-    # Группируем и считаем среднюю цену
-    room_avg = df.groupby('rooms_cat')['price'].mean()
+@register_task(7, task_7_data)
+def task_7_plot(data):
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
 
-    # Добавляем отсутствующие категории (если таких данных нет)
-    for cat in room_order:
-        if cat not in room_avg.index:
-            room_avg[cat] = 0
-    room_avg = room_avg[room_order]
+    room_avg = data['room_avg']
 
     # Создаем график
     fig9, ax9 = plt.subplots(figsize=(10, 6))
-    bars = ax9.bar(room_order, room_avg.values)
+    bars = ax9.bar(ROOM_ORDER, room_avg.values)
 
     # Настраиваем подписи
-    ax9.set_xticks(range(len(room_order)))
-    ax9.set_xticklabels(room_labels)
+    ax9.set_xticks(range(len(ROOM_ORDER)))
+    ax9.set_xticklabels(ROOM_LABELS)
     ax9.set_title('Средняя цена по количеству комнат')
     ax9.set_ylabel('Цена')
     ax9.yaxis.set_major_formatter(mtick.FuncFormatter(format_price))
@@ -445,7 +485,7 @@ try:
 
     # Формируем подробное описание для README
     room_prices = [
-        f"- {room_labels[i]}: {int(price / 1_000_000)} млн руб."
+        f"- {ROOM_LABELS[i]}: {int(price / 1_000_000)} млн руб."
         for i, price in enumerate(room_avg.values)
     ]
 
@@ -454,9 +494,187 @@ try:
             "Включая студии (0 комнат).\n\n" +
             "\n".join(room_prices)
     )
+    return fig9, description
+
+
+def init_worker():
+    # Графики только сохраняются в файлы: неинтерактивный бэкенд и сброс стилей в каждом обработчике.
+    # matplotlib и seaborn импортируются только здесь и в функциях рисования - --help и подготовка их не ждут
+    import matplotlib
+    import seaborn as sns
+
+    matplotlib.use('Agg')
+    sns.set(style='whitegrid', font_scale=1.1)
+
+
+def render_key(number, data):
+    # Хэш входных агрегатов задания и кода, который его рисует:
+    # правка подписи одного графика перерисовывает только его
+    from importlib.metadata import version
+
+    _, plot = TASKS[number]
+    digest = hashlib.sha256()
+    digest.update(pickle.dumps(data, protocol=4))
+    digest.update(inspect.getsource(plot).encode('utf-8'))
+    digest.update(inspect.getsource(format_price).encode('utf-8'))
+    digest.update(version('matplotlib').encode('utf-8'))
+    return digest.hexdigest()
+
 
-    save_plot(fig9, 7, description)
-except Exception as e:
-    print(f"Ошибка при создании графика 7: {e}")
+def chart_path(number):
+    return os.path.join(RESULTS_DIR, f"task_{number}.png")
 
-print(f"Обработка завершена. Проверьте папку '{RESULTS_DIR}'")
\ No newline at end of file
+
+def render_task(number, data):
+    # Выполняется в обработчике: рисуем и сохраняем график, возвращаем описание для README
+    import matplotlib.pyplot as plt
+
+    _, plot = TASKS[number]
+    with span(f"render.task_{number}"):
+        try:
+            fig, description = plot(data)
+        except Exception as e:
+            return number, None, f"Ошибка при создании графика {number}: {e}"
+        try:
+            fig.savefig(chart_path(number), bbox_inches='tight')
+            plt.close(fig)
+        except Exception as e:
+            return number, None, f"Ошибка при сохранении графика {number}: {e}"
+    return number, description, None
+
+
+def load_render_cache():
+    if not os.path.exists(RENDER_CACHE_FILENAME):
+        return {}
+    try:
+        with open(RENDER_CACHE_FILENAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_render_cache(cache):
+    tmp_path = RENDER_CACHE_FILENAME + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, RENDER_CACHE_FILENAME)
+
+
+def write_readme(cache):
+    # README собирается целиком: описания перерисованных и пропущенных графиков по порядку заданий
+    with open(README_FILENAME, 'w', encoding='utf-8') as f:
+        f.write("Результаты анализа данных по недвижимости\n")
+        f.write("=" * 50 + "\n\n")
+        for number in sorted(TASKS):
+            entry = cache.get(str(number))
+            if entry is not None:
+                f.write(f"Задание {number}:\n{entry['description']}\n\n")
+
+
+def render_tasks(jobs, workers):
+    if workers <= 1:
+        init_worker()
+        for number, data in jobs:
+            yield render_task(number, data)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = [executor.submit(render_task, number, data) for number, data in jobs]
+        for future in futures:
+            yield future.result()
+
+
+def prepare_data(filter_set, use_snapshot=True):
+    # Загрузка, нормализация и общие фильтры. Готовый набор сохраняется снимком (snapshot.py):
+    # пока не изменились файлы набора, filters.txt и код подготовки, он открывается без разбора parquet
+    import pandas as pd
+    import places
+
+    def build():
+        df = load_data()
+        with span("filters") as s:
+            df = apply_filters(df, filter_set)
+            s.add_rows(len(df))
+        return df
+
+    if not use_snapshot:
+        return build()
+    parts = [filter_set.digest, inspect.getsource(load_data), inspect.getsource(apply_filters),
+             inspect.getsource(places), repr(storage.COMPACT_DTYPES), pd.__version__]
+    df, cached = snapshot.load_snapshot(INPUT_NAME, 'plots', build, parts)
+    if cached:
+        print(f"⚡ Данные из снимка {snapshot.snapshot_path(INPUT_NAME, 'plots')}")
+    return df
+
+
+def run(tasks=None, workers=None, force=False, use_snapshot=True):
+    from aggregates import build_aggregates
+
+    tasks = sorted(TASKS) if tasks is None else tasks
+    unknown = [number for number in tasks if number not in TASKS]
+    if unknown:
+        print(f"❌ Нет заданий {unknown}, доступны: {sorted(TASKS)}")
+        return
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    filter_set = load_filter_set()
+    # Загрузка данных
+    try:
+        df = prepare_data(filter_set, use_snapshot=use_snapshot)
+    except Exception as e:
+        print(f"Ошибка при загрузке данных: {e}")
+        return
+
+    # Все группировки заданий считаются одним проходом по данным
+    with span("aggregates") as s:
+        dataset = Dataset(df, build_aggregates(df), filter_set)
+        s.add_rows(len(df))
+
+    cache = load_render_cache()
+    jobs = []
+    for number in tasks:
+        prepare, _ = TASKS[number]
+        try:
+            with span(f"prepare.task_{number}"):
+                data = prepare(dataset)
+        except Exception as e:
+            print(f"Ошибка при создании графика {number}: {e}")
+            cache.pop(str(number), None)
+            continue
+        key = render_key(number, data)
+        entry = cache.get(str(number))
+        if not force and entry is not None and entry['key'] == key and os.path.exists(chart_path(number)):
+            print(f"⏭ Задание {number}: данные не изменились, график не перерисовывается")
+            continue
+        jobs.append((number, data, key))
+
+    # Все графики из кэша - пул (и импорт matplotlib в нем) не нужен
+    if jobs:
+        if workers is None:
+            workers = min(len(jobs), os.cpu_count() or 1)
+        keys = {number: key for number, _, key in jobs}
+        # В пуле процессов этапы отдельных графиков не видны - только общее время рисования
+        with span("render", workers=workers):
+            for number, description, error in render_tasks([(number, data) for number, data, _ in jobs], workers):
+                if error is not None:
+                    print(error)
+                    cache.pop(str(number), None)
+                    continue
+                cache[str(number)] = {'key': keys[number], 'description': description}
+
+    save_render_cache(cache)
+    write_readme(cache)
+    print(f"Обработка завершена. Проверьте папку '{RESULTS_DIR}'")
+
+
+def parse_args(argv=None):
+    return command_parser('plot').parse_args(argv)
+
+
+def main(args=None):
+    args = args if args is not None else parse_args()
+    with session('plot', args):
+        run(args.tasks, workers=args.workers, force=args.force, use_snapshot=not args.no_snapshot)
+
+
+if __name__ == "__main__":
+    main()
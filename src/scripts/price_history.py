@@ -0,0 +1,134 @@
+import os
+import glob
+import shutil
+import storage
+from instrument import session, span
+from parser_city import command_parser
+
+# Наблюдения цен: одна строка = объявление в одном запуске парсера.
+# Хранилище только дописывается: каждый новый файл парсера - отдельная часть в партиции даты запуска,
+# поэтому добавление запуска не трогает уже записанную историю
+HISTORY_COLUMNS = ['listing_id', 'url', 'crawl_time', 'price', 'total_meters', 'price_per_m2',
+                   'district', 'rooms_count', 'source_file']
+INDEX_DIMENSIONS = ('district', 'rooms_cat')
+
+
+def history_dir(name="merged_data"):
+    return os.path.join(storage.FINAL_DIR, f"{name}.history")
+
+
+def history_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('listing_id', pa.int64()),
+        ('url', pa.string()),
+        ('crawl_time', pa.timestamp('s')),
+        ('price', pa.int64()),
+        ('total_meters', pa.float64()),
+        ('price_per_m2', pa.float64()),
+        ('district', pa.dictionary(pa.int32(), pa.string())),
+        ('rooms_count', pa.int8()),
+        ('source_file', pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+
+def observations(table, seen_at):
+    # table - часть объединенного набора (storage.listing_table), seen_at - время запуска парсера
+    import pyarrow as pa
+    import pandas as pd
+    from dedup_index import listing_ids
+
+    df = table.select(['url', 'price', 'total_meters', 'district', 'rooms_count', 'source_file']).to_pandas()
+    df['listing_id'] = listing_ids(df['url'])
+    df['crawl_time'] = pd.Timestamp(seen_at)
+    meters = df['total_meters'].where(df['total_meters'] > 0)
+    df['price_per_m2'] = (df['price'].astype('float64') / meters).astype('float64')
+    df = df[df['listing_id'].notna()]
+    return pa.Table.from_pandas(df[HISTORY_COLUMNS], schema=history_schema(), preserve_index=False)
+
+
+def append_observations(table, name, part_id, seen_at):
+    # Партиция по дате запуска: запросы за период читают только свои каталоги
+    import pyarrow.parquet as pq
+
+    path = os.path.join(history_dir(name), f"crawl_date={seen_at[:10]}", f"part-{part_id}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(observations(table, seen_at), path)
+    return os.path.relpath(path, history_dir(name))
+
+
+def remove_part(name, relative_path):
+    path = os.path.join(history_dir(name), relative_path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def clear(name="merged_data"):
+    shutil.rmtree(history_dir(name), ignore_errors=True)
+
+
+def load_history(name="merged_data", start=None, end=None, columns=None):
+    # start/end - даты 'YYYY-MM-DD' включительно; лишние партиции не читаются
+    import pandas as pd
+
+    parts = []
+    for partition in sorted(glob.glob(os.path.join(history_dir(name), "crawl_date=*"))):
+        crawl_date = os.path.basename(partition).split("=", 1)[1]
+        if (start is None or crawl_date >= start) and (end is None or crawl_date <= end):
+            parts.extend(sorted(glob.glob(os.path.join(partition, "*.parquet"))))
+    if not parts:
+        return pd.DataFrame(columns=columns or HISTORY_COLUMNS)
+    return pd.concat([pd.read_parquet(path, columns=columns) for path in parts], ignore_index=True)
+
+
+def price_index(name="merged_data", by='district', freq='M', start=None, end=None):
+    # Медианная цена за м² по периодам (freq: D, W, M, Q) и группам by ('district' или 'rooms_cat').
+    # Объявление, встреченное в периоде несколько раз, учитывается один раз - по последнему наблюдению
+    import pandas as pd
+    import places
+    from aggregates import add_rooms_cat
+
+    if by not in INDEX_DIMENSIONS:
+        raise ValueError(f"Индекс строится по {INDEX_DIMENSIONS}, передано: {by}")
+    with span("load_history") as s:
+        df = load_history(name, start=start, end=end,
+                          columns=['listing_id', 'crawl_time', 'price_per_m2', 'district', 'rooms_count'])
+        s.add_rows(len(df))
+    df = df[df['price_per_m2'].notna()]
+    if df.empty:
+        return pd.DataFrame(columns=['period', by, 'median_price_per_m2', 'listings'])
+    if by == 'rooms_cat':
+        add_rooms_cat(df)
+    # Названия районов приводятся к каноническим, как в кубе: история хранит их как были на странице
+    places.normalize_places(df)
+    df['period'] = df['crawl_time'].dt.to_period(freq).dt.start_time
+    df = df.sort_values('crawl_time', kind='stable').drop_duplicates(['period', 'listing_id'], keep='last')
+    index = df.groupby(['period', by], observed=True).agg(
+        median_price_per_m2=('price_per_m2', 'median'),
+        listings=('listing_id', 'count'),
+    )
+    return index.reset_index()
+
+
+def parse_args(argv=None):
+    return command_parser('index').parse_args(argv)
+
+
+def main(args=None):
+    import pandas as pd
+
+    args = args if args is not None else parse_args()
+    with session('index', args):
+        index = price_index(args.output, by=args.by, freq=args.freq, start=args.start, end=args.end)
+    if index.empty:
+        print(f"❌ Нет наблюдений цен в {history_dir(args.output)}. Запустите merge.py")
+        return
+    table = index.pivot(index='period', columns=args.by, values='median_price_per_m2').round(-2)
+    with pd.option_context('display.width', 200, 'display.max_columns', 50):
+        print(f"📈 Медианная цена за м² по {args.by}, период {args.freq}:")
+        print(table)
+
+
+if __name__ == "__main__":
+    main()
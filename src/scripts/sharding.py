@@ -0,0 +1,86 @@
+import math
+import re
+
+# Выдача cian.ru отдает не больше 75 страниц по ~28 объявлений, остальное молча отбрасывается.
+# Плотный сегмент делится пополам по площади, а когда площадь делить уже некуда - по цене,
+# пока каждая часть не уложится в лимит; число страниц части считается по числу объявлений
+PAGE_SIZE = 28
+MAX_PAGES = 75
+MIN_AREA_STEP = 1
+# Площадь в выдаче указана не точнее сотых: левая часть деления заканчивается на сотую раньше границы
+AREA_EPSILON = 0.01
+MIN_PRICE_STEP = 10_000
+PRICE_RANGE = (0, 10_000_000_000)
+# Нижняя граница для деления цены в логарифмической шкале: цены распределены примерно логнормально
+PRICE_FLOOR = 1_000_000
+# Число объявлений на первой странице выдачи: JSON состояния страницы или заголовок "Найдено N объявлений"
+COUNT_PATTERNS = [
+    re.compile(r'"(?:offersCount|offerCount|aggregatedCount|totalOffers)"\s*:\s*(\d+)'),
+    re.compile(r'Найден[оа]?\s+([\d\s]+?)\s+объявлени'),
+]
+
+
+def offers_count(html):
+    for pattern in COUNT_PATTERNS:
+        match = pattern.search(html)
+        if match:
+            return int(re.sub(r'\D', '', match.group(1)))
+    return None
+
+
+def page_count(count, page_size=PAGE_SIZE):
+    return max(1, math.ceil(count / page_size))
+
+
+def split_area(shard):
+    # Части не пересекаются: [low, middle - 0.01] и [middle, high] - объявление на границе
+    # попадает только в правую часть и не собирается дважды. Границы - дробные (сотые), каждая часть
+    # строго уже исходной; None - делить по площади нечего, дальше делится цена
+    low, high = shard["min_area"], shard["max_area"]
+    if high - low <= MIN_AREA_STEP:
+        return None
+    middle = round((low + high) / 2, 2)
+    middle = int(middle) if middle == int(middle) else middle  # целая граница - и в имени файла (125_250)
+    left_max = round(middle - AREA_EPSILON, 2)
+    if middle <= low or left_max < low or middle > high:
+        return None
+    return [dict(shard, max_area=left_max), dict(shard, min_area=middle)]
+
+
+def split_price(shard):
+    # Цена целая - части не пересекаются
+    low, high = shard.get("min_price", PRICE_RANGE[0]), shard.get("max_price", PRICE_RANGE[1])
+    if high - low <= MIN_PRICE_STEP:
+        return None
+    middle = round(math.sqrt(max(low, PRICE_FLOOR) * high), -4)
+    middle = int(min(max(middle, low + MIN_PRICE_STEP // 2), high - MIN_PRICE_STEP // 2))
+    return [dict(shard, min_price=low, max_price=middle), dict(shard, min_price=middle + 1, max_price=high)]
+
+
+def plan_shards(segment, count_fn, page_size=PAGE_SIZE, max_pages=MAX_PAGES):
+    # count_fn(shard) -> число объявлений в выдаче части или None, если его не удалось узнать.
+    # Возвращает части с полями pages/offers (пустые части пропускаются) и число проб
+    capacity = page_size * max_pages
+    shards = []
+    probes = 0
+    stack = [dict(segment)]
+    while stack:
+        shard = stack.pop()
+        count = count_fn(shard)
+        probes += 1
+        if count is None:
+            # Без числа объявлений часть собирается как раньше - до лимита страниц
+            shards.append(dict(shard, pages=max_pages, offers=None))
+            continue
+        if count == 0:
+            continue
+        if count <= capacity:
+            shards.append(dict(shard, pages=page_count(count, page_size), offers=count))
+            continue
+        halves = split_area(shard) or split_price(shard)
+        if halves is None:
+            shards.append(dict(shard, pages=max_pages, offers=count, truncated=True))
+            continue
+        # Обход в глубину слева направо: части идут по возрастанию площади и цены
+        stack.extend(reversed(halves))
+    return shards, probes
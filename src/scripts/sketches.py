@@ -0,0 +1,94 @@
+import math
+import numpy as np
+import pandas as pd
+
+# Скетч квантилей на логарифмических корзинах (как DDSketch): положительное x попадает в корзину
+# ceil(log(x) / log(GAMMA)), GAMMA = (1 + A) / (1 - A). Значение корзины отличается от любого x в ней
+# не больше чем на долю A, поэтому оценка квантиля - тоже в пределах A (1%) от точного значения.
+# Скетч - это счетчики корзин: скетчи частей, файлов и процессов складываются без потери точности
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+
+def bin_index(values):
+    # Номер корзины; для пустых и неположительных значений - <NA>
+    values = pd.to_numeric(pd.Series(values), errors='coerce').astype('float64')
+    bins = np.ceil(np.log(values.where(values > 0)) / LOG_GAMMA)
+    return bins.astype('Int16')
+
+
+def bin_value(bins):
+    # Середина корзины в смысле относительной ошибки
+    return 2 * np.power(GAMMA, np.asarray(bins, dtype='float64')) / (GAMMA + 1)
+
+
+def sketch(keys, values, measure):
+    # Длинная таблица скетча: ключи группы, measure - имя величины, bin, count
+    frame = keys.copy()
+    frame['bin'] = bin_index(values).to_numpy()
+    frame = frame[frame['bin'].notna()]
+    columns = list(keys.columns)
+    counts = frame.groupby(columns + ['bin'], observed=True, dropna=False).size().rename('count').reset_index()
+    counts.insert(len(columns), 'measure', measure)
+    counts['count'] = counts['count'].astype('int64')
+    return counts
+
+
+def merge_sketches(table, keys):
+    # Свертка скетчей до ключей keys: счетчики одинаковых корзин складываются
+    return table.groupby(list(keys) + ['measure', 'bin'], observed=True, dropna=False)['count'].sum().reset_index()
+
+
+def _ranks(table, keys):
+    # Свернутые корзины по возрастанию внутри групп: счетчик, накопленный счетчик и размер группы
+    merged = merge_sketches(table, keys)
+    merged = merged.sort_values(keys + ['bin'], kind='stable') if keys else merged.sort_values('bin')
+    counts = merged['count'].to_numpy()
+    if keys:
+        grouped = merged.groupby(keys, observed=True, dropna=False, sort=False)['count']
+        cumulative = grouped.cumsum().to_numpy()
+        total = grouped.transform('sum').to_numpy()
+    else:
+        cumulative = np.cumsum(counts)
+        total = np.full(len(counts), counts.sum())
+    return merged, counts, cumulative, total
+
+
+def _by_keys(frame, values, keys, name):
+    values = pd.Series(values, name=name)
+    if not keys:
+        return values.iloc[0] if len(values) else np.nan
+    values.index = pd.MultiIndex.from_frame(frame[keys]) if len(keys) > 1 else pd.Index(frame[keys[0]])
+    return values
+
+
+def quantiles(table, keys, q):
+    # Квантиль q по группам keys из длинной таблицы скетча одной величины.
+    # Ранг floor(q * (n - 1)) - нижнее из соседних значений, без интерполяции - ищется
+    # по накопленным счетчикам корзин, отсортированных по возрастанию
+    keys = list(keys)
+    merged, counts, cumulative, total = _ranks(table, keys)
+    rank = np.floor(q * (total - 1))
+    hit = (cumulative > rank) & (cumulative - counts <= rank)
+    result = merged.loc[hit, keys + ['bin']]
+    return _by_keys(result, bin_value(result['bin']), keys, q)
+
+
+def trimmed_means(table, keys, lower=0.05, upper=0.95):
+    # Среднее по группам без значений за квантилями lower/upper за один проход по корзинам:
+    # из каждой корзины берется столько значений, сколько их рангов попадает между рангами квантилей
+    # lower и upper (floor(q * (n - 1)), как в quantiles).
+    # Каждое значение заменено серединой корзины, поэтому и среднее - в пределах RELATIVE_ACCURACY
+    keys = list(keys)
+    merged, counts, cumulative, total = _ranks(table, keys)
+    low = np.floor(lower * (total - 1))
+    high = np.floor(upper * (total - 1))
+    # Ранги значений корзины: от cumulative - counts до cumulative - 1
+    kept = np.minimum(cumulative - 1, high) - np.maximum(cumulative - counts, low) + 1
+    merged = merged.assign(kept=np.clip(kept, 0, None))
+    merged['weighted'] = merged['kept'] * bin_value(merged['bin'])
+    if not keys:
+        return merged['weighted'].sum() / merged['kept'].sum() if merged['kept'].sum() else np.nan
+    sums = merged.groupby(keys, observed=True, dropna=False)[['weighted', 'kept']].sum()
+    return (sums['weighted'] / sums['kept']).rename('mean')
@@ -0,0 +1,153 @@
+import glob
+import hashlib
+import json
+import os
+import storage
+from instrument import span
+
+# Снимки подготовленного набора (прочитан, типизирован, нормализован, отфильтрован) в Arrow IPC без сжатия.
+# Файл открывается через memory map: числа и строки остаются колонками Arrow на страницах файла (без копии,
+# общие для нескольких процессов - plots, блокноты), в память копируются только коды категорий.
+# Ключ снимка - размеры и mtime файлов набора и индекса дублей в raw/final плюс то, чем набор готовили (фильтры, код):
+# любое изменение набора дает другой ключ, и снимок собирается заново
+SNAPSHOT_DIR = os.path.join(storage.RAW_DIR, 'snapshots')
+KEY_METADATA = b'parser_city.snapshot_key'
+PARTS_METADATA = b'parser_city.snapshot_parts'
+# Тип значений категорий (string/str) Arrow не сохраняет - записываем сами, чтобы типы совпадали с исходными
+CATEGORIES_METADATA = b'parser_city.snapshot_categories'
+
+
+def snapshot_path(name, stage):
+    return os.path.join(SNAPSHOT_DIR, f"{name}.{stage}.arrow")
+
+
+def dataset_files(name="merged_data"):
+    # Файлы, из которых читается объединенный набор (каталог частей или один файл)
+    path = storage.merged_path(name)
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True))
+    return [path]
+
+
+def snapshot_key(name, parts=()):
+    # Изменение, добавление или удаление файла набора, индекса дублей (по нему набор очищается от повторов)
+    # и любая из parts меняют ключ
+    import dedup_index
+
+    digest = hashlib.sha256()
+    index = dedup_index.index_path(name)
+    for path in dataset_files(name) + ([index] if os.path.exists(index) else []):
+        stat = os.stat(path)
+        digest.update(json.dumps([os.path.relpath(path, storage.FINAL_DIR), stat.st_size, stat.st_mtime_ns]).encode())
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def write_snapshot(df, path, key, parts=()):
+    import pandas as pd
+    import pyarrow as pa
+
+    # Строки из частей набора приходят кусками: без склейки пакеты файла дробились бы по границам кусков,
+    # и каждая категория при открытии собиралась бы из сотен словарей
+    table = pa.Table.from_pandas(df, preserve_index=False).combine_chunks()
+    metadata = dict(table.schema.metadata or {})
+    metadata[KEY_METADATA] = key.encode('utf-8')
+    metadata[PARTS_METADATA] = json.dumps([str(part) for part in parts], ensure_ascii=False).encode('utf-8')
+    categories = {column: str(df[column].cat.categories.dtype) for column in df.columns
+                  if isinstance(df[column].dtype, pd.CategoricalDtype)}
+    metadata[CATEGORIES_METADATA] = json.dumps(categories).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Без сжатия: сжатые буферы пришлось бы распаковывать в память, а не отображать
+    with pa.OSFile(path + ".tmp", 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=1 << 20)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def open_table(path, key=None):
+    # Таблица Arrow поверх отображенного в память файла (zero-copy), ключ снимка и то, из чего он собран;
+    # None - снимка нет, он поврежден или его ключ не равен key. Такой файл сразу закрывается: открытое
+    # отображение не дало бы заменить снимок (os.replace на Windows)
+    import pyarrow as pa
+
+    if not os.path.exists(path):
+        return None, None, ()
+    source = pa.memory_map(path, 'r')
+    try:
+        reader = pa.ipc.open_file(source)
+        metadata = reader.schema.metadata or {}
+        stored_key = metadata.get(KEY_METADATA, b'').decode('utf-8')
+        parts = json.loads(metadata.get(PARTS_METADATA, b'[]'))
+        if key is not None and stored_key != key:
+            source.close()
+            return None, stored_key, parts
+        return reader.read_all(), stored_key, parts
+    except (OSError, pa.ArrowInvalid):
+        source.close()
+        return None, None, ()
+
+
+def _categorical(column, categories_dtype):
+    # Словарь Arrow -> pandas Categorical: копируются только коды (1-2 байта на строку), пустые - код -1
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    dictionary = column.chunk(0).dictionary if column.num_chunks else pa.array([], type=column.type.value_type)
+    categories = pd.Index(dictionary.to_pandas(), dtype=categories_dtype)
+    codes = np.concatenate([pc.fill_null(chunk.indices, -1).to_numpy() for chunk in column.chunks]
+                           or [np.array([], dtype='int8')])
+    dtype = pd.CategoricalDtype(categories, ordered=column.type.ordered)
+    return pd.Categorical.from_codes(codes, dtype=dtype, validate=False)
+
+
+def to_pandas(table):
+    # Колонки без словаря остаются массивами Arrow поверх отображенного файла (pd.ArrowDtype) без копии,
+    # с числом строк растет только перекодировка категорий (копия кодов)
+    import pandas as pd
+    import pyarrow as pa
+
+    categories = json.loads((table.schema.metadata or {}).get(CATEGORIES_METADATA, b'{}'))
+    table = table.unify_dictionaries()
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_dictionary(column.type):
+            columns[name] = _categorical(column, categories.get(name))
+        else:
+            columns[name] = pd.arrays.ArrowExtensionArray(column)
+    return pd.DataFrame(columns, copy=False)
+
+
+def load_snapshot(name, stage, build, parts=()):
+    # Набор из снимка, если он собран по тем же файлам и правилам; иначе build() и новый снимок.
+    # Возвращает (DataFrame, True - открыт снимок / False - собран заново)
+    path = snapshot_path(name, stage)
+    key = snapshot_key(name, parts)
+    with span("snapshot", stage=stage) as s:
+        table, _, _ = open_table(path, key)
+        if table is not None:
+            df = to_pandas(table)
+            s.add_rows(len(df))
+            return df, True
+    df = build()
+    with span("write_snapshot", stage=stage) as s:
+        write_snapshot(df, path, key, parts)
+        s.add_rows(len(df))
+    # Дальше работаем с открытым снимком: те же типы колонок, что и при следующих запусках
+    table, _, _ = open_table(path)
+    return to_pandas(table), False
+
+
+def open_dataset(name="merged_data", stage='plots'):
+    # Для блокнотов: готовый снимок без сборки; снимок устаревшего набора не открывается
+    path = snapshot_path(name, stage)
+    table, stored_key, parts = open_table(path)
+    if table is None:
+        raise FileNotFoundError(f"Нет снимка {path}. Запустите plots.py")
+    if stored_key != snapshot_key(name, parts):
+        raise FileNotFoundError(f"Снимок {path} устарел: набор в raw/final изменился. Запустите plots.py")
+    return to_pandas(table)
@@ -0,0 +1,268 @@
+import glob
+import os
+from instrument import span
+
+# pandas и pyarrow импортируются внутри функций: модуль подключают и парсер, и CLI,
+# которым для --help и меню тяжелые библиотеки не нужны
+
+# Корень проекта: src/scripts/ -> BIGdata/
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+RAW_DIR = os.path.join(BASE_DIR, 'raw')
+PARQUET_DIR = os.path.join(RAW_DIR, 'parquet')
+FINAL_DIR = os.path.join(RAW_DIR, 'final')
+
+# Формат хранения по умолчанию; Excel остается только как экспорт
+DEFAULT_FORMAT = os.environ.get('PARSER_CITY_FORMAT', 'parquet')
+
+# Явные типы колонок объявлений, чтобы файлы разных запусков читались одинаково
+LISTING_DTYPES = {
+    'type_property': 'string',
+    'author': 'string',
+    'author_type': 'string',
+    'url': 'string',
+    'location': 'string',
+    'deal_type': 'string',
+    'accommodation_type': 'string',
+    'floor': 'Int64',
+    'floors_count': 'Int64',
+    'rooms_count': 'Int64',
+    'total_meters': 'float64',
+    'price_per_month': 'Int64',
+    'commissions': 'Int64',
+    'price': 'Int64',
+    'district': 'string',
+    'street': 'string',
+    'house_number': 'string',
+    'underground': 'string',
+    'residential_complex': 'string',
+    'source_file': 'string',
+}
+
+# Компактное представление тех же колонок в памяти и в объединенном наборе: повторяющиеся строки
+# (районы, улицы, метро, имена файлов) - категории, целые - минимальной достаточной ширины
+COMPACT_DTYPES = {
+    'type_property': 'category',
+    'author': 'category',
+    'author_type': 'category',
+    'url': 'string',
+    'location': 'category',
+    'deal_type': 'category',
+    'accommodation_type': 'category',
+    'floor': 'Int16',
+    'floors_count': 'Int16',
+    'rooms_count': 'Int8',
+    'total_meters': 'float64',
+    'price_per_month': 'Int64',
+    'commissions': 'Int16',
+    'price': 'Int64',
+    'district': 'category',
+    'street': 'category',
+    'house_number': 'string',
+    'underground': 'category',
+    'residential_complex': 'category',
+    'source_file': 'category',
+}
+CATEGORY_COLUMNS = [column for column, dtype in COMPACT_DTYPES.items() if dtype == 'category']
+
+
+def apply_schema(df, complete=False):
+    import pandas as pd
+
+    df = df.loc[:, [c for c in df.columns if not str(c).startswith('Unnamed:')]].copy()
+    if complete:
+        # Ровно колонки схемы: части одного набора данных должны совпадать по структуре
+        df = df.reindex(columns=list(LISTING_DTYPES))
+    if 'rooms_count' in df.columns:
+        # Студия = 0 комнат (как в задании 7 plots.py)
+        df['rooms_count'] = df['rooms_count'].replace('studio', 0)
+    for column, dtype in LISTING_DTYPES.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'string':
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                # Уже словарная колонка (compact, чтение parquet с read_dictionary)
+                continue
+            df[column] = df[column].astype('string')
+        elif dtype == 'Int64':
+            df[column] = pd.to_numeric(df[column], errors='coerce').round().astype('Int64')
+        else:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+    # Прочие колонки со смешанными типами parquet не запишет
+    for column in df.columns:
+        if column not in LISTING_DTYPES and df[column].dtype == object:
+            df[column] = df[column].astype('string')
+    return df
+
+
+def compact(df, complete=False):
+    # Типы LISTING_DTYPES, затем категории и узкие целые COMPACT_DTYPES
+    df = apply_schema(df, complete=complete)
+    for column, dtype in COMPACT_DTYPES.items():
+        if column in df.columns and df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def compact_arrow_schema():
+    import pyarrow as pa
+
+    types = {
+        'string': pa.string(),
+        'category': pa.dictionary(pa.int32(), pa.string()),
+        'Int8': pa.int8(),
+        'Int16': pa.int16(),
+        'Int64': pa.int64(),
+        'float64': pa.float64(),
+    }
+    return pa.schema([(column, types[dtype]) for column, dtype in COMPACT_DTYPES.items()])
+
+
+def _read_parquet(path, columns=None):
+    import pandas as pd
+    return pd.read_parquet(path, columns=columns)
+
+
+def _write_parquet(df, path):
+    apply_schema(df).to_parquet(path, index=False)
+
+
+def _read_excel(path, columns=None):
+    import pandas as pd
+    return pd.read_excel(path, usecols=columns)
+
+
+def _write_excel(df, path):
+    df.to_excel(path, index=False)
+
+
+def _read_csv(path, columns=None):
+    import pandas as pd
+    return pd.read_csv(path, usecols=columns)
+
+
+def _write_csv(df, path):
+    df.to_csv(path, index=False)
+
+
+# Расширение файла -> (чтение, запись)
+BACKENDS = {
+    'parquet': (_read_parquet, _write_parquet),
+    'xlsx': (_read_excel, _write_excel),
+    'csv': (_read_csv, _write_csv),
+}
+
+
+def _backend(path):
+    ext = os.path.splitext(path)[1].lstrip('.').lower()
+    if ext not in BACKENDS:
+        raise ValueError(f"Неподдерживаемый формат файла: {path}")
+    return BACKENDS[ext]
+
+
+def read_table(path, columns=None):
+    reader, _ = _backend(path)
+    with span("read_table", file=os.path.basename(path)) as s:
+        df = reader(path, columns=columns)
+        s.add_rows(len(df))
+    return df
+
+
+def write_table(df, path):
+    _, writer = _backend(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with span("write_table", file=os.path.basename(path)) as s:
+        writer(df, path)
+        s.add_rows(len(df))
+    return path
+
+
+def partition_dir(city, object_type, crawl_date):
+    return os.path.join(PARQUET_DIR, f"city={city}", f"object_type={object_type}", f"crawl_date={crawl_date}")
+
+
+def raw_path(base_filename, city, object_type, timestamp, fmt=DEFAULT_FORMAT):
+    # timestamp в формате %Y%m%d_%H%M%S, дата запуска становится партицией
+    crawl_date = f"{timestamp[:4]}-{timestamp[4:6]}-{timestamp[6:8]}"
+    filename = f"{base_filename}_{timestamp}"
+    if fmt == 'parquet':
+        return os.path.join(partition_dir(city, object_type, crawl_date), f"{filename}.parquet")
+    return os.path.join(RAW_DIR, f"{filename}.{fmt}")
+
+
+def save_raw(df, base_filename, city, object_type, timestamp, fmt=DEFAULT_FORMAT, export_excel=False):
+    path = write_table(df, raw_path(base_filename, city, object_type, timestamp, fmt))
+    if export_excel and fmt != 'xlsx':
+        write_table(df, os.path.join(RAW_DIR, f"{base_filename}_{timestamp}.xlsx"))
+    return path
+
+
+def list_raw_files(pattern="*"):
+    # Сырые файлы запусков: партиции parquet и старые .xlsx в raw/
+    parquet_files = glob.glob(os.path.join(PARQUET_DIR, "**", f"{pattern}.parquet"), recursive=True)
+    excel_files = glob.glob(os.path.join(RAW_DIR, f"{pattern}.xlsx"))
+    return sorted(parquet_files) + sorted(excel_files)
+
+
+def merged_dataset_dir(name="merged_data"):
+    # Объединенные данные - каталог частей parquet, по одной на исходный файл
+    return os.path.join(FINAL_DIR, name)
+
+
+def listing_table(df):
+    import pyarrow as pa
+
+    # Колоночное представление Arrow: компактно и дешево передается между процессами.
+    # Схема фиксированная (строки - словари int32), чтобы части одного набора совпадали по структуре
+    return pa.Table.from_pandas(compact(df, complete=True), schema=compact_arrow_schema(), preserve_index=False)
+
+
+def write_merged_part(table, name, part_id):
+    import pyarrow.parquet as pq
+
+    path = os.path.join(merged_dataset_dir(name), f"part-{part_id}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path)
+    return path
+
+
+def export_merged_excel(name="merged_data"):
+    path = os.path.join(FINAL_DIR, f"{name}.xlsx")
+    load_listings(name).to_excel(path, index=False)
+    return path
+
+
+def merged_path(name="merged_data"):
+    # Предпочитаем набор parquet, старые выгрузки .xlsx читаются как раньше
+    dataset_dir = merged_dataset_dir(name)
+    if os.path.isdir(dataset_dir) and glob.glob(os.path.join(dataset_dir, "*.parquet")):
+        return dataset_dir
+    for fmt in ('parquet', 'xlsx', 'csv'):
+        path = os.path.join(FINAL_DIR, f"{name}.{fmt}")
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"Не найден объединенный файл {name} в {FINAL_DIR}")
+
+
+def load_merged(name="merged_data"):
+    import pandas as pd
+
+    path = merged_path(name)
+    df = pd.read_parquet(path) if os.path.isdir(path) else read_table(path)
+    return apply_schema(df)
+
+
+def load_listings(name="merged_data", columns=None):
+    # Общий загрузчик объединенных данных (plots, dedup_index, выгрузка в Excel) в компактных типах;
+    # строки parquet сразу читаются словарями, без промежуточной строковой колонки
+    import pandas as pd
+
+    path = merged_path(name)
+    with span("load_listings", dataset=name) as s:
+        if os.path.isdir(path) or path.endswith('.parquet'):
+            dictionary = [c for c in CATEGORY_COLUMNS if columns is None or c in columns]
+            df = pd.read_parquet(path, columns=columns, read_dictionary=dictionary)
+        else:
+            df = read_table(path, columns=columns)
+        df = compact(df)
+        s.add_rows(len(df))
+    return df
@@ -0,0 +1,95 @@
+import glob
+import os
+import shutil
+import storage
+from instrument import span
+
+# Потоковая запись результатов парсера: строки копятся до CHUNK_ROWS и сбрасываются отдельной частью
+# parquet в каталог частей - ее можно читать (pd.read_parquet(каталог)) прямо во время сбора.
+# В конце части по одной собираются в итоговый файл, так что в памяти никогда не больше одной части
+CHUNK_ROWS = 5000
+
+
+def _conform(table, schema):
+    # Часть приводится к общей схеме: недостающие колонки - пустые, типы - как в схеме
+    import pyarrow as pa
+
+    columns = [table.column(field.name).cast(field.type) if field.name in table.column_names
+               else pa.nulls(table.num_rows, field.type) for field in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class StreamingWriter:
+    def __init__(self, parts_dir, chunk_rows=CHUNK_ROWS):
+        self.parts_dir = parts_dir
+        self.chunk_rows = chunk_rows
+        self.buffer = []
+        self.chunks = 0
+        self.rows = 0
+        self.seen = set()
+        # Части прерванного запуска не продолжаются: его страницы заново приходят из журнала
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+
+    def write(self, rows):
+        # Повторы url между страницами выдачи пропускаются (в памяти только множество url)
+        for row in rows:
+            url = row.get("url")
+            if url is not None:
+                if url in self.seen:
+                    continue
+                self.seen.add(url)
+            self.buffer.append(row)
+        if len(self.buffer) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        import pandas as pd
+
+        if not self.buffer:
+            return
+        path = os.path.join(self.parts_dir, f"chunk-{self.chunks:05d}.parquet")
+        with span("write_chunk") as s:
+            df = storage.apply_schema(pd.DataFrame(self.buffer))
+            # Часть появляется под своим именем только целиком
+            df.to_parquet(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+            s.add_rows(len(df))
+        self.chunks += 1
+        self.rows += len(self.buffer)
+        self.buffer = []
+
+    def chunk_paths(self):
+        return sorted(glob.glob(os.path.join(self.parts_dir, "chunk-*.parquet")))
+
+    def close(self, path):
+        # Итоговый файл в формате по расширению path; каталог частей удаляется
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.flush()
+        chunks = self.chunk_paths()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with span("assemble", file=os.path.basename(path)) as s:
+            if not chunks:
+                storage.write_table(pd.DataFrame(), path)
+            else:
+                schemas = [pq.read_schema(chunk).remove_metadata() for chunk in chunks]
+                schema = pa.unify_schemas(schemas, promote_options='permissive')
+                if path.endswith('.parquet'):
+                    # Каждая часть - отдельная группа строк итогового файла
+                    with pq.ParquetWriter(path, schema) as writer:
+                        for chunk in chunks:
+                            writer.write_table(_conform(pq.read_table(chunk), schema))
+                elif path.endswith('.csv'):
+                    for i, chunk in enumerate(chunks):
+                        df = _conform(pq.read_table(chunk), schema).to_pandas()
+                        df.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False, encoding='utf-8')
+                else:
+                    # .xlsx пишется только целиком
+                    tables = [_conform(pq.read_table(chunk), schema) for chunk in chunks]
+                    storage.write_table(pa.concat_tables(tables).to_pandas(), path)
+            s.add_rows(self.rows)
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+        return path
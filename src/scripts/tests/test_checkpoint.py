@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkpoint import CrawlJournal
+
+
+def test_resume_after_torn_write(tmp_path):
+    path = str(tmp_path / "segment.jsonl")
+    journal = CrawlJournal(path)
+    journal.append_page(1, [{"url": "https://cian.ru/sale/flat/1/"}])
+    journal.append_page(2, [{"url": "https://cian.ru/sale/flat/2/"}])
+    # Падение посреди записи страницы 3
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"page": 3, "rows": [{"url": "https://cian')
+
+    resumed = CrawlJournal(path)
+    assert resumed.pages == {1, 2}
+    resumed.append_page(3, [{"url": "https://cian.ru/sale/flat/3/"}])
+    resumed.append_page(4, [])
+
+    # Страницы после оборванной строки не теряются при следующем продолжении
+    again = CrawlJournal(path)
+    assert again.pages == {1, 2, 3, 4}
+    assert again.row_count == 3
+    assert [page for page, _ in again.replay()] == [1, 2, 3, 4]
+
+
+def test_unterminated_last_line_is_dropped(tmp_path):
+    # Запись оборвалась ровно перед переводом строки: следующая страница не должна склеиться с ней
+    path = str(tmp_path / "segment.jsonl")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"page": 1, "rows": []}\n{"page": 2, "rows": []}')
+    journal = CrawlJournal(path)
+    assert journal.pages == {1}
+    journal.append_page(2, [])
+    assert CrawlJournal(path).pages == {1, 2}
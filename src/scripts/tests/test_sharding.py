@@ -0,0 +1,38 @@
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sharding import split_area, plan_shards, MIN_AREA_STEP
+
+
+def test_split_area_fractional_bounds():
+    # Дробные границы: обе части строго уже исходной и не перевернуты
+    left, right = split_area({"min_area": 39, "max_area": 40.99})
+    assert left["min_area"] <= left["max_area"] < right["min_area"] <= right["max_area"]
+    assert (left["min_area"], right["max_area"]) == (39, 40.99)
+    assert right != {"min_area": 39, "max_area": 40.99}
+    assert split_area({"min_area": 40, "max_area": 40 + MIN_AREA_STEP}) is None
+
+
+def test_dense_narrow_range_terminates():
+    # Плотные объявления между 40 и 44 м²: площадь делится до MIN_AREA_STEP, дальше - цена
+    rng = random.Random(1)
+    listings = [(round(rng.uniform(40, 44), 2), rng.randrange(3_000_000, 30_000_000)) for _ in range(20_000)]
+
+    def count(shard):
+        return sum(shard["min_area"] <= area <= shard["max_area"]
+                   and shard.get("min_price", 0) <= price <= shard.get("max_price", 10_000_000_000)
+                   for area, price in listings)
+
+    shards, probes = plan_shards({"min_area": 0, "max_area": 250}, count, page_size=28, max_pages=5)
+    assert probes < 2000
+    assert all(shard["min_area"] <= shard["max_area"] for shard in shards)
+    assert any("min_price" in shard for shard in shards)
+    # Каждое объявление - ровно в одной части
+    for area, price in listings[:500]:
+        hits = [shard for shard in shards
+                if shard["min_area"] <= area <= shard["max_area"]
+                and shard.get("min_price", 0) <= price <= shard.get("max_price", 10_000_000_000)]
+        assert len(hits) == 1